@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""
+
+Copyright (c) 2015 by SAS Institute Inc., Cary, NC 27513 USA
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+Python routines for preprocessing MNIST digits in memory
+
+"""
+
+from .digit_preprocess_py import iter_normalized, normalize_row, \
+    normalize_rows, normalize_scale, normalize_scale_batch
@@ -21,7 +21,10 @@ Simple Python routines for preprocessing MNIST digits
 
 """
 
+import itertools
+import multiprocessing
 import os
+import shutil
 import sys
 import cv2
 import numpy
@@ -30,6 +33,7 @@ import numpy
 INPUT_SIZE = (28, 28)    # size of input image, 2-tuple
 OUT_SIZE = (27, 27)      # size of output image, 2-tuple
 IN_OBS = 2000            # number of input file records
+BLOCK_OBS = 10000        # number of input records normalized at once
 
 # final bounding box size for normalized images,
 # 2-tuple, < out_size
@@ -87,52 +91,387 @@ def normalize_scale(src, out_size=OUT_SIZE, norm_size=NORM_SIZE,
         return cv2.copyMakeBorder(norm, norm_expand_size, norm_expand_size,
                                   norm_expand_size, norm_expand_size, 0)
 
-def main():
+def resize_batch(images, size):
 
-    """ Driver method
+    """ Resizes a batch of images of equal shape, passing up to 512 images at
+        a time to cv2 as the channels of a single image
+
+        Args:
+            images: images as 3-D numpy array, one image per row
+            size: desired size of output images, 2-tuple
 
-        Opens input data, cycles through each row, normalizes each row as an
-        image, and writes to an output file
+        Returns:
+            The resized images as a 3-D numpy array
 
     """
 
-    # io
-    github_data_dir = sys.argv[1]
+    max_channels = 512 # most channels cv2 resizes at once
+    out = numpy.empty((len(images), size[1], size[0]), dtype=images.dtype)
+    for start in range(0, len(images), max_channels):
+        block = images[start:start + max_channels]
+        resized = cv2.resize(numpy.ascontiguousarray(block.transpose(1, 2, 0)),
+                             (size))
+        out[start:start + len(block)] = numpy.reshape(resized,
+            (size[1], size[0], len(block))).transpose(2, 0, 1)
+    return out
+
+def normalize_scale_batch(src, out_size=OUT_SIZE, norm_size=NORM_SIZE,
+                          norm_expand_size=NORM_EXPAND_SIZE,
+                          skinny_threshold=SKINNY_THRESHOLD,
+                          to_black_threshold=TO_BLACK_THRESHOLD):
+
+    """ Normalizes image scale of many images at once, as normalize_scale does
+        for each image; bounding boxes are found with vectorized row and
+        column reductions and images are resized in groups of equal bounding
+        box shape
+
+        Args:
+            src: images as 3-D numpy array, one image per row
+            out_size: desired size of output image (square)
+            norm_size: desired size of image within out_size (square)
+            norm_expand_size: how much norm size needs to be expanded to fill
+                              out_size
+            skinny_threshold: prevents narrow numbers from being stretched
+                              horizontally
+            to_black_threshold: a value below which pixel intensities are
+                                thresholded
+
+        Returns:
+            The normalized images as a 3-D numpy array
+
+        Raises:
+            ValueError: norm_size does not fill out_size, or blank image
+
+    """
+
+    if (norm_size[0] + 2*norm_expand_size,
+            norm_size[1] + 2*norm_expand_size) != tuple(out_size):
+        raise ValueError('Expanded norm_size must equal out_size.')
+
+    src[src < to_black_threshold] = 0
+
+    # find bounding boxes of all images
+    rows = numpy.any(src, axis=2)
+    cols = numpy.any(src, axis=1)
+    if not numpy.all(numpy.any(rows, axis=1)):
+        raise ValueError('Cannot normalize blank image.')
+    bottom = numpy.argmax(rows, axis=1)
+    top = rows.shape[1] - 1 - numpy.argmax(rows[:, ::-1], axis=1)
+    left = numpy.argmax(cols, axis=1)
+    right = cols.shape[1] - 1 - numpy.argmax(cols[:, ::-1], axis=1)
+    skinny = left >= skinny_threshold
+
+    out = numpy.zeros((len(src), out_size[1], out_size[0]), dtype=src.dtype)
+
+    # resize skinny images whole
+    if numpy.any(skinny):
+        out[skinny] = resize_batch(src[skinny], out_size)
+
+    # resize other bounding boxes, grouped by shape, into a black border
+    height = top - bottom + 1
+    width = right - left + 1
+    for h, w in set(zip(height[~skinny], width[~skinny])):
+        index = numpy.nonzero(~skinny & (height == h) & (width == w))[0]
+        box_rows = bottom[index, None] + numpy.arange(h)
+        box_cols = left[index, None] + numpy.arange(w)
+        boxes = src[index[:, None, None], box_rows[:, :, None],
+                    box_cols[:, None, :]]
+        out[index, norm_expand_size:norm_expand_size + norm_size[1],
+            norm_expand_size:norm_expand_size + norm_size[0]] =\
+            resize_batch(boxes, norm_size)
+    return out
+
+def normalize_row(row):
+
+    """ Normalizes the scale of a single input record
+
+        Args:
+            row: sequence of a label followed by INPUT_SIZE pixel intensities,
+                 as strings or numbers
+
+        Returns:
+            The label followed by the normalized, flattened image as a 1-D
+            numpy array
+
+    """
+
+    # read row into image
+    row_array = numpy.asarray(row)
+    row_array = row_array.astype(numpy.float32)
+    img = numpy.reshape(row_array[1:], (INPUT_SIZE))
+
+    # normalize scale
+    norm = normalize_scale(img)
+
+    # flatten
+    out_row = numpy.array(norm).flatten()
+    out_row = out_row.reshape((1, OUT_SIZE[0]**2))
+
+    return numpy.insert(out_row, 0, row_array[0])
+
+def normalize_rows(rows):
+
+    """ Normalizes the scale of a block of input records at once
+
+        Args:
+            rows: 2-D array of records, one per row, each a label followed by
+                  INPUT_SIZE pixel intensities
+
+        Returns:
+            The labels followed by the normalized, flattened images as a 2-D
+            numpy array, one record per row
+
+    """
+
+    # read rows into images
+    rows_array = numpy.array(rows, dtype=numpy.float32)
+    imgs = numpy.reshape(rows_array[:, 1:], (len(rows_array),) + INPUT_SIZE)
+
+    # normalize scale
+    norm = normalize_scale_batch(imgs)
+
+    # flatten
+    return numpy.column_stack((rows_array[:, 0],
+                               numpy.reshape(norm, (len(norm), -1))))
+
+def read_blocks(file_in, block_obs=BLOCK_OBS):
+
+    """ Reads an input csv file in blocks of records, each parsed with a
+        single call
+
+        Args:
+            file_in: open input file, positioned after the header
+            block_obs: number of records in each block
+
+        Yields:
+            Blocks of records as 2-D numpy arrays, one record per row
+
+        Raises:
+            ValueError: a record does not hold a label and INPUT_SIZE pixel
+                        intensities
+
+    """
+
+    n_col = INPUT_SIZE[0]*INPUT_SIZE[1] + 1
+    while True:
+        lines = list(itertools.islice(file_in, block_obs))
+        if len(lines) == 0:
+            return
+        block = numpy.fromstring(''.join(lines).replace('\n', ','),
+                                 dtype=numpy.float32, sep=',')
+        if len(block) != len(lines)*n_col:
+            raise ValueError('Expected ' + str(n_col) + ' values per record.')
+        yield numpy.reshape(block, (len(lines), n_col))
+
+def format_rows(block):
+
+    """ Formats a block of output records as csv lines, exactly as
+        str(row.tolist())[1:-1] formats each record, but formatting each
+        distinct value only once
+
+        Args:
+            block: 2-D numpy array of output records
+
+        Returns:
+            The lines of all records as a single string
+
+    """
+
+    values, index = numpy.unique(block, return_inverse=True)
+    strings = numpy.array([repr(value) for value in
+                           values.astype(numpy.float64).tolist()],
+                          dtype=object)
+    strings = strings[numpy.reshape(index, block.shape)]
+    return ''.join([', '.join(row) + '\n' for row in strings.tolist()])
+
+def chunk_offsets(file_in, n_chunk):
+
+    """ Splits the remainder of an open input file into byte ranges that
+        start and end on line breaks
+
+        Args:
+            file_in: open input file, positioned at the first record
+            n_chunk: number of byte ranges
+
+        Returns:
+            Sorted list of the offsets at which each range starts, followed
+            by the end of the file; empty ranges are dropped
+
+    """
+
+    start = file_in.tell()
+    file_in.seek(0, os.SEEK_END)
+    end = file_in.tell()
+
+    # move each boundary forward to the start of the next line
+    offsets = [start, end]
+    for k in range(1, n_chunk):
+        file_in.seek(start + k*(end - start)/n_chunk - 1)
+        file_in.readline()
+        offsets.append(min(file_in.tell(), end))
+    return sorted(set(offsets))
+
+def iter_lines(file_in, end):
+
+    """ Lazily reads lines from an open input file up to a byte offset
+
+        Args:
+            file_in: open input file
+            end: offset at which to stop reading, at the start of a line
+
+        Yields:
+            Each line before end
+
+    """
+
+    while file_in.tell() < end:
+        yield file_in.readline()
+
+def map_chunk(i, file_in_loc, begin, end, file_out_loc):
+
+    """ In each process: normalizes the records in one byte range of the
+        input file, block by block, and writes them to an intermediate output
+        file named after file_out_loc and the chunk index
+
+        Args:
+            i: chunk index
+            file_in_loc: path of input file
+            begin: offset of first record of the chunk
+            end: offset after last record of the chunk
+            file_out_loc: path of final output file
+
+    """
+
+    process_name = multiprocessing.current_process().name
+    print process_name + ': Processing chunk ' + str(i) + ' ...'
 
-    file_in_loc = github_data_dir + os.sep + 'digits_train_sample.csv'
-    file_out = open(github_data_dir + os.sep +
-                    'digits_train_sample_processed.csv', 'w+')
     file_in = open(file_in_loc, 'rb')
+    file_in.seek(begin)
+    file_out = open(file_out_loc + '.' + str(i), 'w')
 
-    # cycle through all images
-    for i, row in enumerate(file_in):
+    for block in read_blocks(iter_lines(file_in, end)):
+        file_out.write(format_rows(normalize_rows(block)))
 
-        row = row.split(',')
+    file_in.close()
+    file_out.close()
+
+    print process_name + ': Done.'
+
+def normalize_parallel(file_in_loc, start, file_out_loc, n_process):
+
+    """ Normalizes the records of the input file in n_process processes, each
+        handling a byte range of the file, then appends their intermediate
+        output files to the final output file in the order of the input rows
+
+        Args:
+            file_in_loc: path of input file
+            start: offset of the first record, after the header
+            file_out_loc: path of final output file, which already holds the
+                          header
+            n_process: number of processes
+
+        Raises:
+            Exception: a process failed
+
+    """
+
+    file_in = open(file_in_loc, 'rb')
+    file_in.seek(start)
+    offsets = chunk_offsets(file_in, n_process)
+    file_in.close()
+
+    processes = []
+    for i in range(0, len(offsets) - 1):
+        process = multiprocessing.Process(target=map_chunk,
+                                          name='Process_' + str(i),
+                                          args=(i, file_in_loc, offsets[i],
+                                                offsets[i + 1], file_out_loc))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+        if process.exitcode != 0:
+            print 'ERROR: ' + process.name + ' failed.'
+            raise Exception
+
+    # append chunks in order of input rows
+    file_out = open(file_out_loc, 'ab')
+    for i in range(0, len(offsets) - 1):
+        chunk_loc = file_out_loc + '.' + str(i)
+        with open(chunk_loc, 'rb') as chunk:
+            shutil.copyfileobj(chunk, file_out)
+        os.remove(chunk_loc)
+    file_out.close()
 
-        if i == 0: # row 0 is column names
-            header = ','.join(row[0:OUT_SIZE[0]**2 + 1])
-            file_out.write(header + '\n')
+def iter_normalized(rows):
 
-        if i > 0:
+    """ Lazily normalizes the scale of input records, for use from other
+        Python code without writing any files
 
-            if i % 100 == 0:
-                print 'Processing image ' + str(i) + ' ...'
+        Args:
+            rows: iterable of records, each a sequence of a label followed by
+                  INPUT_SIZE pixel intensities, or a line of such values
+                  separated by commas, without a header
+
+        Yields:
+            The label followed by the normalized, flattened image of each
+            record as a 1-D numpy array
+
+    """
 
-            # read row into image
-            row_array = numpy.asarray(row)
-            row_array = row_array.astype(numpy.float32)
-            img = numpy.reshape(row_array[1:], (INPUT_SIZE))
+    for row in rows:
+        if isinstance(row, basestring):
+            row = row.split(',')
+        yield normalize_row(row)
+
+def main():
+
+    """ Driver method
 
-            # normalize scale
-            norm = normalize_scale(img)
+        Opens input data, cycles through blocks of rows, normalizes all rows
+        of each block as images at once, and writes each block to an output
+        file; if a number of processes greater than 1 is given as the second
+        argument, the input file is split into that many chunks, which are
+        normalized in parallel
 
-            # flatten
-            out_row = numpy.array(norm).flatten()
+    """
+
+    # io
+    github_data_dir = sys.argv[1]
+    n_process = 1
+    if len(sys.argv) > 2 and sys.argv[2].strip() != '':
+        n_process = int(sys.argv[2])
+
+    file_in_loc = github_data_dir + os.sep + 'digits_train_sample.csv'
+    file_out_loc = github_data_dir + os.sep +\
+        'digits_train_sample_processed.csv'
+    file_out = open(file_out_loc, 'w+')
+    file_in = open(file_in_loc, 'rb')
 
-            # add to output
-            out_row = out_row.reshape((1, OUT_SIZE[0]**2))
-            out_row = numpy.insert(out_row, 0, row_array[0])
-            file_out.write(str(out_row.tolist())[1:-1] + '\n')
+    # row 0 is column names
+    row = file_in.readline().split(',')
+    header = ','.join(row[0:OUT_SIZE[0]**2 + 1])
+    file_out.write(header + '\n')
+
+    # conditionally normalize chunks of images in parallel
+    if n_process > 1:
+        start = file_in.tell()
+        file_in.close()
+        file_out.close()
+        normalize_parallel(file_in_loc, start, file_out_loc, n_process)
+        print 'Done.'
+        return
+
+    # cycle through blocks of images
+    n_obs = 0
+    for block in read_blocks(file_in):
+
+        n_obs += len(block)
+        print 'Processing images ' + str(n_obs - len(block) + 1) + ' to ' +\
+            str(n_obs) + ' ...'
+
+        # normalize block and add to output
+        file_out.write(format_rows(normalize_rows(block)))
 
     file_in.close()
     file_out.close()
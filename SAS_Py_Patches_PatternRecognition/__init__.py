@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2015 by SAS Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+Generators that create patches and downsampled images in memory, without
+writing any files. Each generator yields batches as tuples of a uint8 pixel
+matrix, with one flattened patch or image per row, and a list of metadata
+tuples, one per row. Example usage:
+
+>>> from SAS_Py_Patches_PatternRecognition import iter_patches
+>>> for pixels, meta in iter_patches(['cat.jpg'], tile_size=100):
+...     train(pixels)
+
+iter_pixel_csv yields batches of the same form from csv files written by the
+scripts, such as patches.csv and images.csv. open_patch_store memory maps
+the npy output of a run with patch store (-x) set, in which find_image and
+find_region look up patches by binary search.
+
+"""
+
+from .threaded_tile import iter_patches, make_tiles
+from .threaded_tile_r import iter_random_patches, make_random_tiles
+from .threaded_downsample import iter_downsampled, downsample_image
+from .pixel_csv import iter_pixel_csv, read_pixel_csv
+from .patch_store import open_patch_store, find_image, find_region
+from .threaded_common import open_greyscale
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2015 by SAS Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+Lookups in a patch store, the output directory of a threaded_tile.py or
+threaded_tile_r.py run with npy output format (-f npy) and patch store
+(-x True). The rows of patches.npy and patches_meta.npy are then sorted by
+orig_name, x, y, size and angle, so the patches of an image, or of a range of
+x within an image, are adjacent rows found by binary search. Both files are
+memory mapped, so only the rows that are used are read from disk, and
+slicing the pixel matrix with a slice of rows does not copy it. Example usage:
+
+>>> from SAS_Py_Patches_PatternRecognition import open_patch_store,\
+...     find_region
+>>> pixels, meta = open_patch_store('test_out')
+>>> rows = find_region(meta, 'test_image_03.JPG', 100, 300, 200, 400)
+>>> overlay(pixels[rows], meta[rows])
+
+"""
+
+# imports
+
+import json
+import numpy as np
+import os
+
+def open_patch_store(out_dir, prefix='patches'):
+
+    """ Memory maps the pixel matrix and metadata of a patch store.
+
+    Args:
+        out_dir: Output directory of a run with patch store (-x) set.
+        prefix: Name of the pixel .npy file without extension.
+
+    Returns:
+        Tuple of the read-only memory-mapped uint8 pixel matrix, with one
+        flattened patch per row, and the memory-mapped metadata array, with
+        fields orig_name, x, y, size and angle.
+
+    Raises:
+        EnvironmentError: Problem reading the files.
+        ValueError: The rows are not sorted as a patch store.
+    """
+
+    with open(out_dir + os.sep + prefix + '.schema.json', 'r') as f:
+        schema = json.load(f)
+
+    if schema.get('sorted_by', [])[:3] != ['orig_name', 'x', 'y']:
+        raise ValueError('Rows of ' + out_dir + os.sep + prefix + '.npy are'\
+                         ' not sorted; rerun with patch store (-x True).')
+
+    pixels = np.load(out_dir + os.sep + schema['pixels']['file'],\
+                     mmap_mode='r')
+    meta = np.load(out_dir + os.sep + schema['metadata']['file'],\
+                   mmap_mode='r')
+
+    return pixels, meta
+
+def find_image(meta, orig_name):
+
+    """ Finds the rows of all patches of an image by binary search.
+
+    Args:
+        meta: Metadata array of a patch store.
+        orig_name: File name of the original image.
+
+    Returns:
+        Slice of rows, empty if the image has no patches. Indexing the pixel
+        matrix with it does not copy the patches.
+    """
+
+    names = meta['orig_name']
+
+    return slice(np.searchsorted(names, orig_name, 'left'),\
+                 np.searchsorted(names, orig_name, 'right'))
+
+def find_region(meta, orig_name, x_min, x_max, y_min=None, y_max=None):
+
+    """ Finds the rows of the patches of an image whose upper-lefthand corner
+    lies in a region. Rows with x_min <= x <= x_max are found by binary search
+    within the rows of the image, then filtered by y if y bounds are given.
+
+    Args:
+        meta: Metadata array of a patch store.
+        orig_name: File name of the original image.
+        x_min: Smallest x coordinate of the region.
+        x_max: Largest x coordinate of the region.
+        y_min: Smallest y coordinate of the region. (default=None)
+        y_max: Largest y coordinate of the region. (default=None)
+
+    Returns:
+        Slice of rows if neither y bound is given, otherwise array of row
+        indices in ascending order.
+    """
+
+    rows = find_image(meta, orig_name)
+    x = meta['x'][rows]
+    start = rows.start + np.searchsorted(x, x_min, 'left')
+    stop = rows.start + np.searchsorted(x, x_max, 'right')
+
+    if y_min == None and y_max == None:
+        return slice(start, stop)
+
+    y = meta['y'][start:stop]
+    keep = np.ones(len(y), dtype=bool)
+    if y_min != None:
+        keep &= y >= y_min
+    if y_max != None:
+        keep &= y <= y_max
+
+    return start + np.nonzero(keep)[0]
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2015 by SAS Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+Fast reader for csv files of flattened images, such as the patches.csv and
+images.csv files written by threaded_tile.py, threaded_tile_r.py and
+threaded_downsample.py, or MNIST digit files. Columns whose names start with
+'pixel' hold pixel intensities and must be adjacent; all other columns, before
+or after them, are metadata. The pixel intensities of each batch of rows are
+parsed by a single numpy call, rather than by splitting every value into its
+own string. Example usage:
+
+>>> from SAS_Py_Patches_PatternRecognition import iter_pixel_csv
+>>> for pixels, meta in iter_pixel_csv('test_out/patches.csv'):
+...     train(pixels)
+
+"""
+
+# imports
+
+import csv
+import itertools
+import numpy as np
+
+def pixel_columns(header):
+
+    """ Finds the adjacent pixel intensity columns of a csv header.
+
+    Args:
+        header: List of column names.
+
+    Returns:
+        Tuple of the index of the first pixel column and the index after the
+        last pixel column.
+
+    Raises:
+        ValueError: No pixel columns, or pixel columns are not adjacent.
+    """
+
+    index_list = [j for j, name in enumerate(header)\
+                    if name.strip().startswith('pixel')]
+    if len(index_list) == 0 or\
+            index_list[-1] - index_list[0] + 1 != len(index_list):
+        raise ValueError('Expected adjacent pixel columns in csv header.')
+
+    return index_list[0], index_list[-1] + 1
+
+def parse_field(text):
+
+    """ Converts a metadata value to int or float if possible.
+
+    Args:
+        text: Metadata value from a csv row.
+
+    Returns:
+        The value as int, float or, if it is not a number, string.
+    """
+
+    for type_ in [int, float]:
+        try:
+            return type_(text)
+        except ValueError:
+            pass
+
+    return text.strip()
+
+def iter_pixel_csv(csv_name, dtype=np.uint8, batch_size=4096):
+
+    """ Lazily reads a csv file of flattened images in batches of rows. The
+    pixel intensities of a batch are joined and parsed by one np.fromstring
+    call. Metadata values are split from each row with at most two bounded
+    string splits, unless the row contains quoted values, which are parsed by
+    the csv module.
+
+    Args:
+        csv_name: Path of a csv file with a header row.
+        dtype: Numpy type of the pixel matrix. Values of integer types are
+               checked to be within range. Use np.float32 for files with
+               fractional pixel intensities. (default=np.uint8)
+        batch_size: Number of rows in each batch.
+
+    Yields:
+        Tuples of a pixel matrix, with one row per csv row, and a list of
+        metadata tuples, one per row, with the values of all non-pixel
+        columns in order.
+
+    Raises:
+        ValueError: Problem with the header, or a row does not hold the
+                    expected number of valid pixel intensities.
+    """
+
+    # local constants
+
+    parse_dtype = np.dtype(dtype)
+    if np.issubdtype(parse_dtype, np.integer):
+        parse_dtype = np.dtype(np.int64)
+
+    with open(csv_name, 'rb') as f:
+
+        header = next(csv.reader([f.readline()]))
+        first, last = pixel_columns(header)
+        n_pixel = last - first
+        n_trail = len(header) - last
+
+        while True:
+
+            lines = list(itertools.islice(f, batch_size))
+            if len(lines) == 0:
+                return
+
+            # split metadata from pixel intensities of each row
+
+            pixel_list = []
+            meta_list = []
+            for line in lines:
+
+                line = line.rstrip('\r\n')
+                if line == '':
+                    continue
+
+                if '"' in line:
+                    fields = next(csv.reader([line]))
+                    pixel_list.append(','.join(fields[first:last]))
+                    meta = fields[:first] + fields[last:]
+                else:
+                    fields = line.split(',', first)
+                    meta = fields[:first]
+                    pixel_text = fields[-1]
+                    if n_trail > 0:
+                        fields = pixel_text.rsplit(',', n_trail)
+                        pixel_text = fields[0]
+                        meta.extend(fields[1:])
+                    pixel_list.append(pixel_text)
+
+                meta_list.append(tuple([parse_field(text) for text in meta]))
+
+            if len(meta_list) == 0:
+                continue
+
+            # parse all pixel intensities of the batch at once
+
+            pixels = np.fromstring(','.join(pixel_list), dtype=parse_dtype,\
+                                   sep=',')
+            if len(pixels) != len(meta_list)*n_pixel:
+                raise ValueError('Expected ' + str(n_pixel) + ' numeric'\
+                                 ' pixel values in each row of ' + csv_name +\
+                                 '.')
+            if parse_dtype != dtype and len(pixels) > 0:
+                info = np.iinfo(dtype)
+                if pixels.min() < info.min or pixels.max() > info.max:
+                    raise ValueError('Pixel values of ' + csv_name +\
+                                     ' out of range of ' +\
+                                     np.dtype(dtype).name + '.')
+
+            yield pixels.astype(dtype).reshape(len(meta_list), n_pixel),\
+                meta_list
+
+def read_pixel_csv(csv_name, dtype=np.uint8, batch_size=4096):
+
+    """ Reads a whole csv file of flattened images with iter_pixel_csv.
+
+    Args:
+        csv_name: Path of a csv file with a header row.
+        dtype: Numpy type of the pixel matrix. (default=np.uint8)
+        batch_size: Number of rows parsed at once.
+
+    Returns:
+        Tuple of a pixel matrix, with one row per csv row, and a list of
+        metadata tuples, one per row.
+    """
+
+    pixel_list = []
+    meta_list = []
+    for pixels, meta in iter_pixel_csv(csv_name, dtype, batch_size):
+        pixel_list.append(pixels)
+        meta_list.extend(meta)
+
+    if len(pixel_list) == 0:
+        with open(csv_name, 'rb') as f:
+            first, last = pixel_columns(next(csv.reader([f.readline()])))
+        return np.empty((0, last - first), dtype=dtype), meta_list
+
+    return np.vstack(pixel_list), meta_list
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2015 by SAS Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+Tests of patch extraction in threaded_tile.py. From the repository root type:
+
+$ python -m unittest discover -s SAS_Py_Patches_PatternRecognition/tests -t .
+
+"""
+
+# imports
+
+import numpy as np
+import unittest
+
+from SAS_Py_Patches_PatternRecognition.threaded_tile import iter_patches
+
+def random_image(h, w):
+
+    """ Creates a greyscale image of random pixel intensities.
+
+    Args:
+        h: Height of the image measured in pixels.
+        w: Width of the image measured in pixels.
+
+    Returns:
+        h x w uint8 numpy array.
+    """
+
+    return np.random.RandomState(h*w).randint(0, 256, (h, w)).astype(np.uint8)
+
+def patch_meta(images, tile_size):
+
+    """ Collects the metadata of all patches created from images.
+
+    Args:
+        images: List of tuples of an image name and a 2-D numpy array.
+        tile_size: Side length of square image patches measured in pixels.
+
+    Returns:
+        List of (orig_name, x, y, size, angle) metadata tuples.
+    """
+
+    return [meta for _, meta_list in iter_patches(images, tile_size)
+            for meta in meta_list]
+
+class TestSmallImages(unittest.TestCase):
+
+    def test_smaller_than_tile(self):
+
+        images = [('small', random_image(30, 50)),
+                  ('normal', random_image(100, 120))]
+        meta_list = patch_meta(images, 40)
+
+        self.assertTrue(len(meta_list) > 0)
+        self.assertEqual(set([meta[0] for meta in meta_list]), set(['normal']))
+        self.assertEqual(meta_list, patch_meta(images[1:], 40))
+
+    def test_same_size_as_tile(self):
+
+        meta_list = patch_meta([('edge', random_image(40, 40))], 40)
+
+        self.assertEqual(meta_list, [('edge', 0, 0, 40, 0)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,1212 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2015 by SAS Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+Helpers shared by threaded_tile.py, threaded_tile_r.py and
+threaded_downsample.py: queueing image files for workers, starting and
+joining worker processes or threads, decoding and caching greyscale images,
+writing and joining csv and npy output files, incremental runs, sorting a
+patch store and deduplicating patches. The scripts import these helpers, so
+each is defined only here.
+
+"""
+
+# imports
+
+import csv
+import glob
+import hashlib
+import json
+import multiprocessing
+import numpy as np
+import os
+import shutil
+import struct
+import sys
+import threading
+import traceback
+from cStringIO import StringIO
+from multiprocessing import Process, Queue
+from Queue import Empty, Queue as ThreadQueue
+from threading import Thread
+from PIL import Image
+
+def image_names(in_dir):
+
+    """ Lists the image files in in_dir.
+
+    Args:
+        in_dir: Directory in which original image files are located.
+
+    Returns:
+        List of names of image files with standard file extensions.
+    """
+
+    # local constants
+
+    image_type_list = ['JPG', 'JPEG', 'PNG', 'BMP', 'TIFF']
+
+    return [name for name in os.listdir(in_dir)\
+            if name.split('.')[-1].upper() in image_type_list]
+
+def queue_files(n_process, chunk_list, backend='process'):
+
+    """ Creates a queue of image files shared by all processes. Each process
+    takes the next file from the queue as soon as it finishes its previous
+    file, so a chunk of unusually large images does not leave the other
+    processes idle. Files are queued largest first, so the largest images are
+    not left until the end of the run.
+
+    Args:
+        n_process: Number of processes specified by the user.
+        chunk_list: List of lists of image file paths from chunk_files.
+        backend: 'thread' if the queue is shared by threads of this process,
+                 otherwise it is shared by processes.
+
+    Returns:
+        Queue of image file paths, followed by one None per process.
+    """
+
+    file_list = [chunk_file for file_list_ in chunk_list\
+                    for chunk_file in file_list_]
+    file_list.sort(key=os.path.getsize, reverse=True)
+
+    work_queue = Queue()
+    if backend == 'thread':
+        work_queue = ThreadQueue()
+    for chunk_file in file_list:
+        work_queue.put(chunk_file)
+    for _ in range(0, int(n_process)):
+        work_queue.put(None)
+
+    return work_queue
+
+def worker_name():
+
+    """ Returns the name of the current worker, a thread started by
+    start_workers or else the current process.
+
+    Returns:
+        Name of the current thread or process.
+    """
+
+    thread_name = threading.current_thread().name
+    if thread_name != 'MainThread':
+        return thread_name
+
+    return multiprocessing.current_process().name
+
+def run_thread(target, args):
+
+    """ Runs target in a worker thread started by start_workers. An exception
+    in a thread, including the SystemExit raised when a map function calls
+    sys.exit, ends only that thread, so the outcome is recorded as the
+    exitcode attribute of the thread, as for a process: 0 if target returns
+    or exits with status 0, otherwise 1.
+
+    Args:
+        target: Map function run by the thread.
+        args: Tuple of arguments passed to target.
+    """
+
+    thread_ = threading.current_thread()
+    thread_.exitcode = 1
+    try:
+        target(*args)
+        thread_.exitcode = 0
+    except SystemExit as exception_:
+        if exception_.code in [None, 0]:
+            thread_.exitcode = 0
+    except BaseException:
+        traceback.print_exc()
+
+def start_workers(n_process, backend, target, args):
+
+    """ Starts n_process workers, each calling target with its worker index
+    followed by args. Workers are processes unless backend is 'thread', in
+    which case they are threads of this process. Threads need no copies of
+    the images they work on and run in parallel wherever Pillow and NumPy
+    release the GIL.
+
+    Args:
+        n_process: Number of workers specified by the user.
+        backend: 'process', 'thread' or 'hybrid'.
+        target: Map function run by each worker.
+        args: Tuple of arguments passed to target after the worker index.
+
+    Returns:
+        List of started workers, processes or threads.
+    """
+
+    workers = []
+    for i in range(0, int(n_process)):
+        if backend == 'thread':
+            worker = Thread(target=run_thread, name='Thread_' + str(i),\
+                            args=(target, (i,) + args))
+        else:
+            worker = Process(target=target, name='Process_' + str(i),\
+                             args=(i,) + args)
+        worker.start()
+        workers.append(worker)
+
+    return workers
+
+def join_workers(workers):
+
+    """ Waits for workers started by start_workers to finish, and checks that
+    all of them succeeded.
+
+    Args:
+        workers: List of workers, processes or threads.
+
+    Raises:
+        Exception: A worker exited with a non-zero exitcode.
+    """
+
+    for worker in workers:
+        worker.join()
+
+    failed_list = [worker.name for worker in workers if worker.exitcode != 0]
+    if len(failed_list) > 0:
+        print 'Workers failed: ' + ', '.join(failed_list) + '!'
+        raise Exception
+
+def greyscale_key(image):
+
+    """ Identifies an image file by the MD5 hash of its contents, so that
+    cached greyscale arrays remain valid when files are copied, moved or
+    touched, and are never used for changed files.
+
+    Args:
+        image: Path of an image file.
+
+    Returns:
+        Hexadecimal MD5 hash of the image file.
+    """
+
+    # local constants
+
+    buffer_size = 2**20
+
+    md5 = hashlib.md5()
+    with open(image, 'rb') as i:
+        for block in iter(lambda: i.read(buffer_size), ''):
+            md5.update(block)
+
+    return md5.hexdigest()
+
+def evict_greyscale_cache(grey_dir, cache_size, keep_name):
+
+    """ Removes the least recently used greyscale arrays from grey_dir until
+    the arrays in grey_dir take up no more than cache_size megabytes. Arrays
+    that cannot be removed, for instance because they are mapped by another
+    process on Windows, are skipped.
+
+    Args:
+        grey_dir: Directory of decoded greyscale images.
+        cache_size: Size limit of grey_dir measured in megabytes.
+        keep_name: Greyscale array that is never removed, or None.
+    """
+
+    grey_list = []
+    for grey_name in glob.glob(grey_dir + os.sep + 'grey.*.npy'):
+        try:
+            stat = os.stat(grey_name)
+        except OSError:
+            continue
+        grey_list.append((stat.st_mtime, stat.st_size, grey_name))
+
+    total_size = sum([size for _, size, _ in grey_list])
+    for _, size, grey_name in sorted(grey_list):
+        if total_size <= cache_size*2**20:
+            break
+        if grey_name == keep_name:
+            continue
+        try:
+            os.remove(grey_name)
+            total_size -= size
+        except OSError:
+            pass
+
+def decode_greyscale(image, draft_size=None):
+
+    """ Decodes an image file to greyscale. If draft_size is set, JPEG files
+    are decoded directly to greyscale at the smallest scale of 1/2, 1/4 or 1/8
+    that is still at least twice draft_size pixels in each direction, using
+    Image.draft. The margin keeps the final antialias resize close to that of
+    a full resolution image. Other files are decoded at full resolution.
+
+    Args:
+        image: Path of an image file.
+        draft_size: Side length measured in pixels to which the image will be
+                    downsampled after decoding.
+
+    Returns:
+        The greyscale image as 2-D uint8 numpy array.
+    """
+
+    im = Image.open(image)
+    if draft_size != None:
+        im.draft('L', (2*draft_size, 2*draft_size))
+
+    return np.asarray(im.convert('L'))
+
+def open_greyscale(image, grey_dir=None, cache_size=None, draft_size=None):
+
+    """ Opens an image as a greyscale numpy array. If grey_dir is set, image
+    files are decoded only the first time they are opened; the greyscale array
+    is saved to grey_dir as .npy file, keyed by the contents of the image
+    file, and memory mapped from there, also by other processes or later runs,
+    so that the array is held in the page cache rather than in the memory of
+    each process. Each use marks the array as recently used. If cache_size is
+    set, the least recently used arrays are removed from grey_dir to keep it
+    below cache_size megabytes. If draft_size is set, JPEG files are decoded
+    at reduced scale with decode_greyscale and cached separately.
+
+    Args:
+        image: Path of an image file, or tuple of an image name and a PIL
+               image or 2-D numpy array.
+        grey_dir: Directory of decoded greyscale images.
+        cache_size: Size limit of grey_dir measured in megabytes.
+        draft_size: Side length measured in pixels to which the image will be
+                    downsampled after decoding.
+
+    Returns:
+        Tuple of the image name and the greyscale image as 2-D uint8 numpy
+        array.
+    """
+
+    if isinstance(image, basestring):
+
+        name = os.path.basename(image)
+        if grey_dir == None:
+            return name, decode_greyscale(image, draft_size)
+
+        grey_name = grey_dir + os.sep + 'grey.' + greyscale_key(image)
+        if draft_size != None:
+            grey_name += '.draft' + str(draft_size)
+        grey_name += '.npy'
+        try:
+            im_array = np.load(grey_name, mmap_mode='r')
+            os.utime(grey_name, None)
+            return name, im_array
+        except (EnvironmentError, ValueError):
+            pass
+
+        # write to a temporary file first, so no process maps a partial file
+        im_array = decode_greyscale(image, draft_size)
+        tmp_name = grey_name + '.' + str(os.getpid()) + '.' +\
+            str(threading.current_thread().ident)
+        with open(tmp_name, 'wb') as o:
+            np.save(o, im_array)
+        if os.path.exists(grey_name):
+            os.remove(tmp_name)
+        else:
+            os.rename(tmp_name, grey_name)
+
+        if cache_size != None:
+            evict_greyscale_cache(grey_dir, cache_size, grey_name)
+
+        # map the saved array, so that the decoded copy can be freed
+        try:
+            return name, np.load(grey_name, mmap_mode='r')
+        except (EnvironmentError, ValueError):
+            return name, im_array
+
+    name, im = image
+    if isinstance(im, Image.Image):
+        im = im.convert('L')
+
+    return name, np.asarray(im, dtype=np.uint8)
+
+def map_decode(i, work_queue, grey_dir, draft_size=None):
+
+    """ In each worker: decodes images to greyscale and saves them to
+    grey_dir, from which later stages memory map them.
+
+    Args:
+        i: Worker index.
+        work_queue: Queue of image file paths shared by all workers.
+        grey_dir: Directory of decoded greyscale images.
+        draft_size: If set, JPEG files are decoded at the smallest scale
+                    that is at least twice draft_size.
+    """
+
+    # local constants
+
+    process_name = worker_name()
+
+    for chunk_file in iter(work_queue.get, None):
+        print process_name + ': decoding ' + os.path.basename(chunk_file) +\
+            ' ...'
+        open_greyscale(chunk_file, grey_dir, None, draft_size)
+
+    print process_name + ': Done.'
+
+def contour_csv_lines(x, y, z, name):
+
+    """ Formats x,y,z contours as csv rows in a single vectorized pass, with
+    the same text as csv.writer. Each integer is looked up in a table of
+    decimal strings, the fields of all rows are laid out side by side in a
+    uint8 matrix padded with zero bytes, and the padding is dropped.
+
+    Args:
+        x: Array of non-negative integer x values.
+        y: Array of non-negative integer y values.
+        z: Array of non-negative integer z values.
+        name: Original image filename appended to each row.
+
+    Returns:
+        String of csv rows.
+    """
+
+    n = len(x)
+
+    # ',name\r\n', quoted as by csv.writer
+    suffix = StringIO()
+    csv.writer(suffix).writerow(['', name])
+    suffix = np.frombuffer(suffix.getvalue(), dtype=np.uint8)
+
+    # zero padded decimal strings of all values
+    table = np.array([str(v) for v in range(max(x.max(), y.max(), z.max())\
+                        + 1)])
+    table = table.view(np.uint8).reshape(len(table), -1)
+
+    comma = np.empty((n, 1), dtype=np.uint8)
+    comma.fill(ord(','))
+
+    rows = np.hstack([table[x], comma, table[y], comma, table[z],\
+                      np.broadcast_to(suffix, (n, len(suffix)))])
+
+    return rows[rows != 0].tobytes()
+
+def save_chunk_meta(meta_name, meta_list, field_list):
+
+    """ Saves the metadata of the rows written to an intermediate binary file
+    as a numpy structured array. The first field holds the original image
+    filename and any further fields hold integers.
+
+    Args:
+        meta_name: Name of the intermediate .npy file.
+        meta_list: List of metadata tuples, one per row.
+        field_list: Names of the metadata fields.
+
+    Returns:
+        The saved numpy structured array.
+
+    Raises:
+        EnvironemtError: Problem creating .npy file.
+    """
+
+    name_length = max([len(meta[0]) for meta in meta_list] + [1])
+    dtype = [(field_list[0], 'S%d' % name_length)] +\
+        [(field, np.int32) for field in field_list[1:]]
+
+    meta = np.array(meta_list, dtype=dtype)
+    try:
+        np.save(meta_name, meta)
+    except EnvironmentError as exception_:
+        print exception_
+        print 'Failed to create ' + meta_name + '!'
+        sys.exit(-1)
+
+    return meta
+
+def copy_blocks(copy_list, out_name):
+
+    """ In each process: copies whole files into an existing output file, each
+    starting at a given byte offset, using large block reads and writes.
+
+    Args:
+        copy_list: List of (input file name, byte offset) tuples.
+        out_name: Name of the pre-sized output file.
+
+    Raises:
+        EnvironemtError: Problem copying files.
+    """
+
+    # local constants
+
+    buffer_size = 16*1024*1024
+
+    try:
+        with open(out_name, 'r+b') as o:
+            for in_name, offset in copy_list:
+                o.seek(offset)
+                with open(in_name, 'rb') as n:
+                    shutil.copyfileobj(n, o, buffer_size)
+    except EnvironmentError as exception_:
+        print exception_
+        print 'Failed to copy into ' + out_name + '!'
+        sys.exit(-1)
+
+def concat_files(n_process, in_name_list, out_name):
+
+    """ Appends files to the end of out_name in order. The output file is
+    extended once to its final size, the offset of each file is calculated
+    from the sizes of the files before it, and the files are then copied in
+    parallel by n_process processes.
+
+    Args:
+        n_process: Number of processes specified by the user.
+        in_name_list: Names of the files to append, in order.
+        out_name: Name of the output file; must already exist.
+
+    Raises:
+        EnvironemtError: Problem extending output file.
+    """
+
+    # calculate offset of each file
+
+    size_list = [os.path.getsize(in_name) for in_name in in_name_list]
+    offset_list = os.path.getsize(out_name) + np.cumsum([0] + size_list)
+
+    # pre-size output file
+
+    try:
+        with open(out_name, 'r+b') as o:
+            o.truncate(int(offset_list[-1]))
+    except EnvironmentError as exception_:
+        print exception_
+        print 'Failed to extend ' + out_name + '!'
+        sys.exit(-1)
+
+    # balance files across processes by size, then copy in parallel
+
+    copy_lists = [[] for _ in range(0, int(n_process))]
+    copy_sizes = [0]*int(n_process)
+    for j in np.argsort(size_list)[::-1]:
+        k = copy_sizes.index(min(copy_sizes))
+        copy_lists[k].append((in_name_list[j], int(offset_list[j])))
+        copy_sizes[k] += size_list[j]
+
+    processes = []
+    for k, copy_list in enumerate(copy_lists):
+        if len(copy_list) == 0:
+            continue
+        process = Process(target=copy_blocks, name='Copy_' + str(k),\
+                          args=(copy_list, out_name))
+        process.start()
+        processes.append(process)
+    for process_ in processes:
+        process_.join()
+        if process_.exitcode != 0:
+            print 'Failed to copy into ' + out_name + '!'
+            sys.exit(-1)
+
+def save_original_npy_schema(out_dir, n_row, meta_dtype):
+
+    """ Writes out_dir/originals.schema.json, which describes the columns of
+    originals.npy and originals_meta.npy.
+
+    Args:
+        out_dir: Directory in which the final originals.npy file is located.
+        n_row: Number of rows in originals.npy.
+        meta_dtype: Numpy dtype of originals_meta.npy.
+
+    Raises:
+        EnvironemtError: Problem creating schema file.
+    """
+
+    out_schema_name = out_dir + os.sep + 'originals.schema.json'
+
+    schema = {'rows': n_row,\
+              'contours': {'file': 'originals.npy',\
+                           'dtype': 'int32',\
+                           'shape': [n_row, 3],\
+                           'columns': ['x', 'y', 'z']},\
+              'metadata': {'file': 'originals_meta.npy',\
+                           'columns': [{'name': field,\
+                                        'dtype': meta_dtype[field].str}\
+                                        for field in meta_dtype.names]}}
+    try:
+        with open(out_schema_name, 'w') as o:
+            json.dump(schema, o, indent=4)
+    except EnvironmentError as exception_:
+        print exception_
+        print 'Failed to create ' + out_schema_name + '!'
+        sys.exit(-1)
+
+def reduce_join_original_npy(n_process, out_dir):
+
+    """ Creates out_dir/originals.npy, out_dir/originals_meta.npy and
+    out_dir/originals.schema.json. Intermediate binary contour files are
+    concatenated in parallel behind a .npy header into originals.npy, an int32
+    matrix with one x,y,z row per contour point. originals_meta.npy holds the
+    orig_name, width, height, contour step, number of points and first row in
+    originals.npy of each image.
+
+    Args:
+        n_process: Number of processes specified by the user.
+        out_dir: Directory in which to create intermediate files and final
+                 originals.npy file.
+
+    Raises:
+        EnvironemtError: Problem creating .npy or schema file.
+    """
+
+    # local constants
+
+    chunk_dir_list = [out_dir + os.sep + '_chunk_dir' + str(i)\
+                        for i in range(0, n_process)]
+    out_npy_name = out_dir + os.sep + 'originals.npy'
+    out_meta_name = out_dir + os.sep + 'originals_meta.npy'
+
+    # collect intermediate metadata and binary files in the same order
+
+    in_bin_list = []
+    chunk_meta_list = []
+    for i in range(0, n_process):
+        chunk_meta = np.load(chunk_dir_list[i] + os.sep + 'orig' + str(i) +\
+                             '_meta.npy')
+        for name in chunk_meta['orig_name']:
+            in_bin_list.append(chunk_dir_list[i] + os.sep + 'orig.' + name +\
+                               '.bin')
+        chunk_meta_list.append(chunk_meta)
+
+    name_length = max([meta.dtype[0].itemsize for meta in chunk_meta_list])
+    meta = np.zeros(sum([len(meta_) for meta_ in chunk_meta_list]),\
+                    dtype=[('orig_name', 'S%d' % name_length),\
+                           ('width', np.int32), ('height', np.int32),\
+                           ('step', np.int32), ('points', np.int32),\
+                           ('row', np.int64)])
+    for field in ['orig_name', 'width', 'height', 'step', 'points']:
+        meta[field] = np.concatenate([meta_[field] for meta_ in\
+                                      chunk_meta_list])
+    n_point = meta['points'].astype(np.int64)
+    meta['row'] = np.cumsum(n_point) - n_point
+    n_row = int(n_point.sum())
+
+    # create out_dir/originals.npy and concatenate intermediate binary files
+
+    try:
+        np.save(out_meta_name, meta)
+        with open(out_npy_name, 'wb') as o:
+            write_npy_header(o, n_row, 3, '<i4')
+    except EnvironmentError as exception_:
+        print exception_
+        print 'Failed to create ' + out_npy_name + '!'
+        sys.exit(-1)
+
+    concat_files(n_process, in_bin_list, out_npy_name)
+
+    # write schema sidecar
+
+    save_original_npy_schema(out_dir, n_row, meta.dtype)
+
+def write_npy_header(o, n_row, n_col, descr='|u1'):
+
+    """ Writes a fixed length .npy header for a matrix. Because the
+    header length does not depend on n_row, a header can be written before
+    the number of rows is known and overwritten in place afterwards.
+
+    Args:
+        o: File object open for binary writing, positioned at its start.
+        n_row: Number of rows of the matrix.
+        n_col: Number of columns of the matrix.
+        descr: Numpy dtype string of the matrix, uint8 by default.
+    """
+
+    # local constants
+
+    header_length = 128
+
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d, %d), }"\
+        % (descr, n_row, n_col)
+    header = header.ljust(header_length - 11) + '\n'
+    o.write(np.lib.format.magic(1, 0) + struct.pack('<H', len(header)) +\
+            header)
+
+def save_npy_schema(out_dir, prefix, n_row, size, meta_dtype, sorted_by=None):
+
+    """ Writes out_dir/<prefix>.schema.json, which describes the columns of
+    <prefix>.npy and <prefix>_meta.npy.
+
+    Args:
+        out_dir: Directory in which the final <prefix>.npy file is located.
+        prefix: Name of the .npy file without extension, 'patches' or
+                'images'.
+        n_row: Number of rows in <prefix>.npy.
+        size: Side length of square patches or images measured in pixels.
+        meta_dtype: Numpy dtype of <prefix>_meta.npy.
+        sorted_by: List of metadata columns by which the rows are sorted, or
+                   None if the rows are in the order they were written.
+
+    Raises:
+        EnvironemtError: Problem creating schema file.
+    """
+
+    # local constants
+
+    shape_key = {'images': 'image_shape'}.get(prefix, 'patch_shape')
+
+    out_schema_name = out_dir + os.sep + prefix + '.schema.json'
+    n_col = size*size
+
+    schema = {'rows': n_row,\
+              'pixels': {'file': prefix + '.npy',\
+                         'dtype': 'uint8',\
+                         'shape': [n_row, n_col],\
+                         shape_key: [size, size],\
+                         'column_prefix': 'pixel_'},\
+              'metadata': {'file': prefix + '_meta.npy',\
+                           'columns': [{'name': field,\
+                                        'dtype': meta_dtype[field].str}\
+                                        for field in meta_dtype.names]}}
+    if sorted_by != None:
+        schema['sorted_by'] = sorted_by
+
+    try:
+        with open(out_schema_name, 'w') as o:
+            json.dump(schema, o, indent=4)
+    except EnvironmentError as exception_:
+        print exception_
+        print 'Failed to create ' + out_schema_name + '!'
+        sys.exit(-1)
+
+def iter_batches(n_process, out_queue, processes):
+
+    """ Yields the batches that the map processes put on out_queue, until
+    each of the n_process processes has put None to signal that it is done.
+
+    Args:
+        n_process: Number of processes specified by the user.
+        out_queue: Queue shared by the map processes.
+        processes: The map processes, checked if no batch arrives.
+
+    Yields:
+        Tuples of a uint8 pixel matrix, with one row per patch or image, and
+        a list of metadata tuples, one per row.
+
+    Raises:
+        Exception: All map processes exited before signalling they were done.
+    """
+
+    n_done = 0
+    while n_done < n_process:
+        try:
+            batch = out_queue.get(timeout=1)
+        except Empty:
+            if not any([process_.is_alive() for process_ in processes]):
+                print 'Map processes exited without finishing!'
+                raise Exception
+            continue
+        if batch is None:
+            n_done += 1
+        else:
+            yield batch
+
+def reduce_stream(batches, out_dir, prefix, debug, size, output_format,
+                  field_list):
+
+    """ Writes batches of flattened patches or images directly into the final
+    out_dir/<prefix>.csv or out_dir/<prefix>.npy file, without intermediate
+    files.
+
+    Args:
+        batches: Iterable of (pixel matrix, metadata list) tuples, e.g. from
+                 iter_batches.
+        out_dir: Directory in which to create final output file.
+        prefix: Name of the output file without extension, 'patches' or
+                'images'.
+        debug: If true, preserves intermediate working directories.
+        size: Side length of square patches or images measured in pixels -
+              used to create header here.
+        output_format: Format of the final output, 'csv' or 'npy'.
+        field_list: Names of the metadata fields.
+
+    Raises:
+        EnvironemtError: Problem creating output file.
+    """
+
+    out_name = out_dir + os.sep + prefix + '.' + output_format
+    n_col = size*size
+    meta_list = []
+
+    try:
+        o = open(out_name, 'wb')
+    except EnvironmentError as exception_:
+        print exception_
+        print 'Failed to create ' + out_name + '!'
+        sys.exit(-1)
+
+    # write header, then each batch as it arrives
+
+    if output_format == 'npy':
+        write_npy_header(o, 0, n_col)
+    else:
+        wr = csv.writer(o)
+        header = ['pixel_' + str(j) for j in range(0, n_col)]
+        header.extend(field_list)
+        wr.writerow(header)
+
+    for pixels, batch_meta in batches:
+        if output_format == 'npy':
+            o.write(pixels.tobytes())
+            meta_list.extend(batch_meta)
+        else:
+            wr.writerows([row + list(meta) for row, meta in\
+                            zip(pixels.tolist(), batch_meta)])
+
+    # complete npy header, metadata and schema
+
+    if output_format == 'npy':
+        o.seek(0)
+        write_npy_header(o, len(meta_list), n_col)
+        meta = save_chunk_meta(out_dir + os.sep + prefix + '_meta.npy',\
+                               meta_list, field_list)
+        save_npy_schema(out_dir, prefix, len(meta), size, meta.dtype)
+
+    o.close()
+
+    if not debug:
+        for chunk_dir in glob.glob(out_dir + os.sep + '_chunk_dir*'):
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+
+def reduce_join_npy(n_process, out_dir, prefix, debug, size):
+
+    """ Creates out_dir/<prefix>.npy, out_dir/<prefix>_meta.npy and
+    out_dir/<prefix>.schema.json. Intermediate binary pixel files are
+    concatenated behind a .npy header into <prefix>.npy, a uint8 matrix with
+    one row per patch or image. Intermediate metadata arrays are concatenated
+    into <prefix>_meta.npy. <prefix>.schema.json describes the columns of both
+    files.
+
+    Args:
+        n_process: Number of processes specified by the user.
+        out_dir: Directory in which to create intermediate files and final
+                 <prefix>.npy file.
+        prefix: Name of the .npy file without extension, 'patches' or
+                'images'.
+        debug: If true, preserves intermediate working directories.
+        size: Side length of square patches or images measured in pixels -
+              used to shape <prefix>.npy here.
+
+    Raises:
+        EnvironemtError: Problem creating .npy or schema file.
+    """
+
+    # local constants
+
+    chunk_dir_list = [out_dir + os.sep + '_chunk_dir' + str(i)\
+                        for i in range(0, n_process)]
+    bin_name_list = [chunk_dir_list[i] + os.sep + prefix + str(i) + '.bin'\
+                        for i in range(0, n_process)]
+    meta_name_list = [chunk_dir_list[i] + os.sep + prefix + str(i) +\
+                        '_meta.npy' for i in range(0, n_process)]
+
+    out_npy_name = out_dir + os.sep + prefix + '.npy'
+    out_meta_name = out_dir + os.sep + prefix + '_meta.npy'
+
+    # concatenate intermediate metadata arrays into <prefix>_meta.npy
+
+    meta_list = [np.load(meta_name) for meta_name in meta_name_list]
+    name_length = max([meta.dtype[0].itemsize for meta in meta_list])
+    dtype = [(field, meta_list[0].dtype[field]) for field in\
+                meta_list[0].dtype.names]
+    dtype[0] = (dtype[0][0], 'S%d' % name_length)
+    meta = np.concatenate([meta_.astype(dtype) for meta_ in meta_list])
+
+    n_row = len(meta)
+    n_col = size*size
+
+    # create out_dir/<prefix>.npy and concatenate intermediate binary files
+
+    try:
+        np.save(out_meta_name, meta)
+        with open(out_npy_name, 'wb') as o:
+            write_npy_header(o, n_row, n_col)
+    except EnvironmentError as exception_:
+        print exception_
+        print 'Failed to create ' + out_npy_name + '!'
+        sys.exit(-1)
+
+    concat_files(n_process, bin_name_list, out_npy_name)
+
+    # write schema sidecar
+
+    save_npy_schema(out_dir, prefix, n_row, size, meta.dtype)
+
+    if not debug:
+        for chunk_dir in chunk_dir_list:
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+
+def find_changed_images(in_dir, out_dir, parameters, out_name_list):
+
+    """ Compares the image files in in_dir to the manifest written to out_dir
+    by an earlier incremental run. Images are identified by name, size and
+    modification time. If there is no manifest, the manifest was written with
+    different parameters, or an output file of the earlier run is missing,
+    all images are processed again. Otherwise, if any image was added,
+    modified or removed, the output files of the earlier run are moved to
+    out_dir/_previous, to be merged with the output of the new and modified
+    images by merge_previous_csv or merge_previous_npy. The manifest is
+    removed until it is written again by save_manifest, so an interrupted run
+    is never mistaken for a complete one.
+
+    Args:
+        in_dir: Directory in which original image files are located.
+        out_dir: Directory in which final output files are located.
+        parameters: Dict of the options that determine the output files.
+        out_name_list: Names of the output files in out_dir.
+
+    Returns:
+        Tuple of a list of names of new or modified images to process, a set
+        of names of modified or removed images whose earlier rows are dropped,
+        or None if all images are processed again, and a dict of [size, mtime]
+        of each image file in in_dir, for save_manifest.
+
+    Raises:
+        EnvironemtError: Problem moving output files.
+    """
+
+    manifest_name = out_dir + os.sep + 'manifest.json'
+    prev_dir = out_dir + os.sep + '_previous'
+
+    file_dict = {}
+    for name in image_names(in_dir):
+        stat = os.stat(in_dir + os.sep + name)
+        file_dict[name] = [stat.st_size, stat.st_mtime]
+
+    # check manifest and output files of earlier run
+
+    manifest = None
+    if os.path.exists(manifest_name):
+        with open(manifest_name) as i:
+            manifest = json.load(i)
+        manifest['files'] = dict([(name.encode('utf-8'), value) for\
+                                  name, value in manifest['files'].items()])
+    if manifest == None or manifest['parameters'] != parameters or\
+        not all([os.path.exists(out_dir + os.sep + out_name)\
+                 for out_name in out_name_list]):
+        print 'No matching earlier run, processing all images ...'
+        return sorted(file_dict), None, file_dict
+
+    # compare image files to manifest
+
+    name_list = sorted([name for name in file_dict if\
+                        manifest['files'].get(name) != file_dict[name]])
+    drop_set = set([name for name in manifest['files'] if\
+                    manifest['files'][name] != file_dict.get(name)])
+
+    print 'Found %d new or modified and %d removed images.' %\
+        (len(name_list), len(drop_set - set(name_list)))
+
+    if len(name_list) == 0 and len(drop_set) == 0:
+        return name_list, drop_set, file_dict
+
+    # set aside output files of earlier run
+
+    try:
+        os.remove(manifest_name)
+        if os.path.exists(prev_dir):
+            shutil.rmtree(prev_dir, ignore_errors=True)
+        os.mkdir(prev_dir)
+        for out_name in out_name_list:
+            os.rename(out_dir + os.sep + out_name,\
+                      prev_dir + os.sep + out_name)
+    except EnvironmentError as exception_:
+        print exception_
+        print 'Failed to move earlier output to ' + prev_dir + '!'
+        sys.exit(-1)
+
+    return name_list, drop_set, file_dict
+
+def save_manifest(out_dir, parameters, file_dict):
+
+    """ Writes out_dir/manifest.json, which records the parameters of the run
+    and the size and modification time of each processed image file.
+
+    Args:
+        out_dir: Directory in which final output files are located.
+        parameters: Dict of the options that determine the output files.
+        file_dict: Dict of [size, mtime] of each image file.
+
+    Raises:
+        EnvironemtError: Problem creating manifest file.
+    """
+
+    manifest_name = out_dir + os.sep + 'manifest.json'
+    try:
+        with open(manifest_name, 'w') as o:
+            json.dump({'parameters': parameters, 'files': file_dict}, o,\
+                      indent=4)
+    except EnvironmentError as exception_:
+        print exception_
+        print 'Failed to create ' + manifest_name + '!'
+        sys.exit(-1)
+
+def merge_previous_csv(out_dir, out_name, drop_set, name_index):
+
+    """ Merges the rows of out_dir/_previous/out_name, except rows of images in
+    drop_set, and the rows of out_dir/out_name into out_dir/out_name.
+
+    Args:
+        out_dir: Directory in which final output files are located.
+        out_name: Name of the csv file.
+        drop_set: Set of names of images whose earlier rows are dropped.
+        name_index: Index of the orig_name column.
+
+    Raises:
+        EnvironemtError: Problem creating csv file.
+    """
+
+    # local constants
+
+    buffer_size = 2**24
+
+    prev_name = out_dir + os.sep + '_previous' + os.sep + out_name
+    new_name = out_dir + os.sep + out_name
+    tmp_name = new_name + '.tmp'
+
+    try:
+        with open(tmp_name, 'wb') as o, open(prev_name, 'rb') as prev,\
+            open(new_name, 'rb') as new:
+
+            # copy earlier rows, as blocks if no rows are dropped
+            if len(drop_set) == 0:
+                shutil.copyfileobj(prev, o, buffer_size)
+            else:
+                reader = csv.reader(prev)
+                wr = csv.writer(o)
+                wr.writerow(next(reader))
+                wr.writerows([row for row in reader\
+                              if row[name_index] not in drop_set])
+
+            # append new rows without header
+            new.readline()
+            shutil.copyfileobj(new, o, buffer_size)
+
+        os.remove(new_name)
+        os.rename(tmp_name, new_name)
+    except EnvironmentError as exception_:
+        print exception_
+        print 'Failed to create ' + new_name + '!'
+        sys.exit(-1)
+
+def merge_previous_npy(out_dir, prefix, drop_set, size):
+
+    """ Merges the rows of out_dir/_previous/<prefix>.npy and its metadata,
+    except rows of images in drop_set, and the rows of out_dir/<prefix>.npy
+    into out_dir/<prefix>.npy, out_dir/<prefix>_meta.npy and the schema
+    sidecar.
+
+    Args:
+        out_dir: Directory in which final output files are located.
+        prefix: Name of the .npy file without extension.
+        drop_set: Set of names of images whose earlier rows are dropped.
+        size: Side length of square patches or images measured in pixels.
+
+    Raises:
+        EnvironemtError: Problem creating .npy file.
+    """
+
+    # local constants
+
+    block_rows = 2**16
+
+    prev_dir = out_dir + os.sep + '_previous'
+    out_npy_name = out_dir + os.sep + prefix + '.npy'
+    tmp_name = out_npy_name + '.tmp'
+
+    prev = np.load(prev_dir + os.sep + prefix + '.npy', mmap_mode='r')
+    prev_meta = np.load(prev_dir + os.sep + prefix + '_meta.npy')
+    new = np.load(out_npy_name, mmap_mode='r')
+    new_meta = np.load(out_dir + os.sep + prefix + '_meta.npy')
+
+    keep = np.nonzero(~np.in1d(prev_meta['orig_name'], list(drop_set)))[0]
+
+    name_length = max(prev_meta.dtype[0].itemsize, new_meta.dtype[0].itemsize)
+    dtype = [(field, prev_meta.dtype[field]) for field in\
+                prev_meta.dtype.names]
+    dtype[0] = (dtype[0][0], 'S%d' % name_length)
+    meta = np.concatenate([prev_meta[keep].astype(dtype),\
+                           new_meta.astype(dtype)])
+
+    try:
+        with open(tmp_name, 'wb') as o:
+            write_npy_header(o, len(meta), size*size)
+            for j in range(0, len(keep), block_rows):
+                o.write(prev[keep[j:j + block_rows]].tobytes())
+            for j in range(0, len(new), block_rows):
+                o.write(np.ascontiguousarray(new[j:j + block_rows]).tobytes())
+        del new
+        os.remove(out_npy_name)
+        os.rename(tmp_name, out_npy_name)
+        np.save(out_dir + os.sep + prefix + '_meta.npy', meta)
+    except EnvironmentError as exception_:
+        print exception_
+        print 'Failed to create ' + out_npy_name + '!'
+        sys.exit(-1)
+
+    save_npy_schema(out_dir, prefix, len(meta), size, meta.dtype)
+
+def merge_previous_original_npy(out_dir, drop_set):
+
+    """ Merges the contours of out_dir/_previous/originals.npy, except contours
+    of images in drop_set, and the contours of out_dir/originals.npy into
+    out_dir/originals.npy, out_dir/originals_meta.npy and
+    out_dir/originals.schema.json.
+
+    Args:
+        out_dir: Directory in which final output files are located.
+        drop_set: Set of names of images whose earlier contours are dropped.
+
+    Raises:
+        EnvironemtError: Problem creating .npy file.
+    """
+
+    # local constants
+
+    block_rows = 2**20
+
+    prev_dir = out_dir + os.sep + '_previous'
+    out_npy_name = out_dir + os.sep + 'originals.npy'
+    tmp_name = out_npy_name + '.tmp'
+
+    prev = np.load(prev_dir + os.sep + 'originals.npy', mmap_mode='r')
+    prev_meta = np.load(prev_dir + os.sep + 'originals_meta.npy')
+    new = np.load(out_npy_name, mmap_mode='r')
+    new_meta = np.load(out_dir + os.sep + 'originals_meta.npy')
+
+    prev_meta = prev_meta[~np.in1d(prev_meta['orig_name'], list(drop_set))]
+
+    name_length = max(prev_meta.dtype[0].itemsize, new_meta.dtype[0].itemsize)
+    dtype = [(field, prev_meta.dtype[field]) for field in\
+                prev_meta.dtype.names]
+    dtype[0] = (dtype[0][0], 'S%d' % name_length)
+    meta = np.concatenate([prev_meta.astype(dtype), new_meta.astype(dtype)])
+    n_point = meta['points'].astype(np.int64)
+    meta['row'] = np.cumsum(n_point) - n_point
+    n_row = int(n_point.sum())
+
+    try:
+        with open(tmp_name, 'wb') as o:
+            write_npy_header(o, n_row, 3, '<i4')
+            for row, points in zip(prev_meta['row'], prev_meta['points']):
+                for j in range(row, row + points, block_rows):
+                    o.write(np.ascontiguousarray(\
+                        prev[j:min(j + block_rows, row + points)]).tobytes())
+            for j in range(0, len(new), block_rows):
+                o.write(np.ascontiguousarray(new[j:j + block_rows]).tobytes())
+        del new
+        os.remove(out_npy_name)
+        os.rename(tmp_name, out_npy_name)
+        np.save(out_dir + os.sep + 'originals_meta.npy', meta)
+    except EnvironmentError as exception_:
+        print exception_
+        print 'Failed to create ' + out_npy_name + '!'
+        sys.exit(-1)
+
+    save_original_npy_schema(out_dir, n_row, meta.dtype)
+
+def sort_npy(out_dir, prefix, size):
+
+    """ Sorts the rows of out_dir/<prefix>.npy and out_dir/<prefix>_meta.npy
+    by orig_name, x, y, size and angle, and records the order in the schema
+    sidecar. The patches of each image are then adjacent rows, ordered by x,
+    so they can be found by binary search in the memory-mapped files. See
+    patch_store.py.
+
+    Args:
+        out_dir: Directory in which final output files are located.
+        prefix: Name of the .npy file without extension.
+        size: Side length of square images measured in pixels.
+
+    Raises:
+        EnvironemtError: Problem creating .npy file.
+    """
+
+    # local constants
+
+    block_rows = 2**16
+    sort_fields = ['orig_name', 'x', 'y', 'size', 'angle']
+
+    out_npy_name = out_dir + os.sep + prefix + '.npy'
+    out_meta_name = out_dir + os.sep + prefix + '_meta.npy'
+    tmp_name = out_npy_name + '.tmp'
+
+    meta = np.load(out_meta_name)
+    order = np.lexsort([meta[field] for field in reversed(sort_fields)])
+
+    # rewrite rows in blocks, unless they are already in order
+
+    if np.any(order != np.arange(len(order))):
+        pixels = np.load(out_npy_name, mmap_mode='r')
+        try:
+            with open(tmp_name, 'wb') as o:
+                write_npy_header(o, len(meta), size*size)
+                for j in range(0, len(order), block_rows):
+                    o.write(pixels[order[j:j + block_rows]].tobytes())
+            del pixels
+            os.remove(out_npy_name)
+            os.rename(tmp_name, out_npy_name)
+            np.save(out_meta_name, meta[order])
+        except EnvironmentError as exception_:
+            print exception_
+            print 'Failed to create ' + out_npy_name + '!'
+            sys.exit(-1)
+
+    save_npy_schema(out_dir, prefix, len(meta), size, meta.dtype,\
+                    sort_fields)
+
+def average_hash(tile, hash_size=8):
+
+    """ Computes the average hash of a patch. The patch is shrunk to
+    hash_size x hash_size pixels and each bit of the hash records whether one
+    of these pixels is brighter than their mean, so nearly identical patches
+    have the same hash.
+
+    Args:
+        tile: Patch as 2-D uint8 numpy array.
+        hash_size: Side length of the shrunk patch measured in pixels.
+
+    Returns:
+        The hash as a string of hash_size*hash_size/8 bytes.
+    """
+
+    small = np.asarray(Image.fromarray(tile).resize((hash_size, hash_size),\
+                                                    Image.ANTIALIAS))
+
+    return np.packbits(small > small.mean()).tostring()
+
+def is_duplicate(tile, seen_set, shared_dict=None, token=None):
+
+    """ Tests whether the average hash of a patch was seen before, and records
+    it as seen.
+
+    Args:
+        tile: Patch as 2-D uint8 numpy array.
+        seen_set: Set of the hashes seen by the calling worker.
+        shared_dict: Dict of the hashes seen by all workers, such as a
+                     multiprocessing.Manager dict, or None to test seen_set
+                     only.
+        token: Value that the calling worker records in shared_dict.
+
+    Returns:
+        True if the hash was seen before by any worker, otherwise False.
+    """
+
+    key = average_hash(tile)
+    if key in seen_set:
+        return True
+    seen_set.add(key)
+
+    # setdefault checks and records the hash in a single atomic call
+    return shared_dict is not None and\
+        shared_dict.setdefault(key, token) != token
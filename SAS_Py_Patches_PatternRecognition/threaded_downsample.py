@@ -23,7 +23,7 @@ limitations under the License.
 Script using Python multiprocessing and PIL to complete independent image
 preprocessing tasks in parallel. 
 
-Images are copied into n_process seperate folders, converted to greyscale, and 
+Images are split into n_process chunks, converted to greyscale, and
 downsampled to square tiles (default: 25x25). Images are downsampled using
 the -d switch or by setting a value for downsample_size. Images are then 
 flattened and collected into a single csv file, called 'images.csv'. Images.csv
@@ -41,8 +41,8 @@ n_process: (-p) Number of processes to use; the script will create this many
 in_dir: (-i) Directory in which input images are located. This directory should
         contain only image files of type JPG, PNG, BMP or TIFF. The files must
         also have standard file extensions to be recognized by the script.
-        Files will be copied into their respective chunk directories before
-        being tiled, (and/or downsampled,) flattened, and converted to csv.
+        Files are read directly from in_dir by each process and are only
+        copied into their respective chunk directories when -c is set.
 
 out_dir: (-o) Parent directory in which the sub-directories for each chunk of
          image files will be created. A large number temporary files will be
@@ -50,12 +50,58 @@ out_dir: (-o) Parent directory in which the sub-directories for each chunk of
 
 debug: (-g) Leaves temporary files in out_dir. (default=False)
 
+copy_files: (-c) Copies image files into their respective chunk directories
+            before they are processed, rather than reading them directly from
+            in_dir. (default=False)
+
+output_format: (-f) Format of the final output, csv or npy. The npy format
+               writes the uint8 pixel intensities of each image as a row of
+               images.npy, the orig_name of each image as a row of
+               images_meta.npy, and a description of both files to
+               images.schema.json. Both .npy files can be loaded (or memory
+               mapped) with numpy.load without parsing. (default=csv)
+
+stream: (-m) Streams batches of flattened images from each process to a
+        single writer, which writes them directly into the final output
+        file. No intermediate images files are written. (default=False)
+
 downsample_size: (-d) Side length of downsampled square image tiles measured
                  in pixels. Images are downsampled before being flattened, 
                  resulting in each row vector of images.csv containing 
                  downsample_size*downsample_size pixels intensity elements. 
                  (default=25)
 
+draft: (-r) Decodes JPEG files directly to greyscale at the smallest scale of
+       1/2, 1/4 or 1/8 that is still at least twice downsample_size pixels in
+       each direction, before downsampling. Much faster for large photos;
+       pixel intensities differ slightly from a full resolution decode.
+       (default=False)
+
+cache_dir: (-k) Directory in which decoded greyscale images are kept across
+           runs, as memory-mappable .npy files keyed by the MD5 hash of each
+           image file. Runs over the same input images with different
+           settings then skip decoding. (default=None)
+
+cache_size: (-z) Size limit of cache_dir measured in megabytes. At the end
+            of each run, once all stages have read the decoded images, the
+            least recently used images are removed from cache_dir while it
+            is larger than cache_size. (default=2048)
+
+incremental: (-u) Processes only the images that were added to or modified in
+             in_dir since the last incremental run with the same options, and
+             merges their rows into the existing output files, dropping the
+             rows of modified or removed images. Processed images and options
+             are recorded in out_dir/manifest.json. (default=False)
+
+backend: (-b) How images are processed by n_process workers: process,
+         thread or hybrid. With process, each worker is a separate process.
+         With thread, workers are threads of a single process, which need
+         no copies of the images they work on; Pillow decoding and resizing
+         release the GIL, so threads still run in parallel. With hybrid,
+         images are first decoded to out_dir/_grey_dir (or cache_dir) by
+         threads, then downsampled by processes, which memory map the
+         decoded images. (default=process)
+
 Run threaded_downsample.csv from an IDE by setting constants in main OR by the 
 command line. Example command line usage:
 
@@ -69,12 +115,19 @@ import ast
 import csv
 import getopt
 import multiprocessing
+import numpy as np
 import os
 import shutil
 import sys
 import time
-from multiprocessing import Process
+from multiprocessing import Process, Queue
+from Queue import Queue as ThreadQueue
 from PIL import Image
+from threaded_common import concat_files, evict_greyscale_cache,\
+    find_changed_images, image_names, iter_batches, join_workers, map_decode,\
+    merge_previous_csv, merge_previous_npy, open_greyscale, queue_files,\
+    reduce_join_npy, reduce_stream, save_chunk_meta, save_manifest,\
+    start_workers, worker_name
 
 def create_out_dirs(n_process, out_dir):
 
@@ -109,16 +162,25 @@ def create_out_dirs(n_process, out_dir):
 
     print 'Done.'
 
-def chunk_files(n_process, in_dir, out_dir):
+def chunk_files(n_process, in_dir, out_dir, copy_files=False, name_list=None):
 
-    """ Separates the image in in_dir into n_process roughly equal chunks of
-    files, each in a separate directory created by create_out_dirs.
+    """ Separates the images in in_dir into n_process roughly equal chunks of
+    files. By default no files are copied; each chunk is a list of paths into
+    in_dir that the processes read directly. If copy_files is set, the
+    images are also copied into the separate directories created by
+    create_out_dirs and the chunks refer to the copies.
 
     Args:
         n_process: Number of processes specified by the user.
         in_dir: Directory in which original image files are located.
         out_dir: Directory in which to create intermediate files and final
                  images.csv file.
+        copy_files: If true, copies image files into chunk directories.
+        name_list: Names of the image files in in_dir to chunk. By default,
+                   all image files in in_dir are chunked.
+
+    Returns:
+        List of n_process lists of image file paths.
 
     Raises:
         EnvironemtError: Problem copying image files.
@@ -130,16 +192,23 @@ def chunk_files(n_process, in_dir, out_dir):
     # local constants
 
     check_point_value = 1000
-    image_type_list = ['JPG', 'JPEG', 'PNG', 'BMP', 'TIFF']
 
-     # copy files
+    # assign files to chunks, conditionally copy files
+
+    file_list = name_list
+    if file_list == None:
+        file_list = image_names(in_dir)
 
-    file_list = [name for name in os.listdir(in_dir)\
-                    if name.split('.')[-1].upper() in image_type_list]
+    chunk_list = [[] for _ in range(0, int(n_process))]
 
     for i, name in enumerate(file_list):
 
         source_file = in_dir + os.sep + name
+
+        if not copy_files:
+            chunk_list[i % n_process].append(source_file)
+            continue
+
         chunk_outdir = out_dir + os.sep + '_chunk_dir' +\
             str(int(i % n_process))
         chunk_file = chunk_outdir + os.sep + name
@@ -154,84 +223,185 @@ def chunk_files(n_process, in_dir, out_dir):
             print 'Failed to copy' + name + '!'
             sys.exit(-1)
 
+        chunk_list[i % n_process].append(chunk_file)
+
         if i % check_point_value == 0 and i != 0:
             print 'Processing file %i ...' % (i)
 
     print 'Done.'
-    
-def map_downsample(i, out_dir, debug, downsample_size):
+
+    return chunk_list
+
+def downsample_image(im_array, downsample_size):
+
+    """ Conditionally downsamples a greyscale image.
+
+    Args:
+        im_array: Greyscale image as 2-D numpy array.
+        downsample_size: Side length of downsampled square images measured in
+                         pixels. If None, the image is returned unchanged.
+
+    Returns:
+        The conditionally downsampled image as 2-D uint8 numpy array.
+    """
+
+    if downsample_size == None:
+        return im_array
+
+    return np.asarray(Image.fromarray(im_array)\
+        .resize((downsample_size, downsample_size), Image.ANTIALIAS))
+
+def iter_downsampled(images, downsample_size=25, draft=False, batch_size=256):
+
+    """ Lazily converts images to greyscale and downsamples them in the
+    calling process, for use from other Python code without writing any
+    files. Defaults are the same as for the command line.
+
+    Args:
+        images: Iterable of image file paths, or of tuples of an image name
+                and a PIL image or 2-D numpy array.
+        downsample_size: Side length of downsampled square images measured in
+                         pixels. Must be set when batches are yielded, as
+                         images otherwise differ in size.
+        draft: If true, JPEG files are decoded at reduced scale.
+        batch_size: Maximum number of images in each batch.
+
+    Yields:
+        Tuples of a uint8 pixel matrix, with one flattened image per row, and
+        a list of (orig_name,) metadata tuples, one per row.
+    """
+
+    pixel_list, meta_list = [], []
+    draft_size = None
+    if draft:
+        draft_size = downsample_size
+
+    for image in images:
+
+        name, im_array = open_greyscale(image, draft_size=draft_size)
+        pixel_list.append(downsample_image(im_array, downsample_size).flatten())
+        meta_list.append((name,))
+
+        if len(meta_list) == batch_size:
+            yield np.vstack(pixel_list), meta_list
+            pixel_list, meta_list = [], []
+
+    if len(meta_list) > 0:
+        yield np.vstack(pixel_list), meta_list
+
+def map_downsample(i, work_queue, out_dir, debug, downsample_size,
+                   output_format='csv', out_queue=None, grey_dir=None,
+                   draft=False):
 
     """ In each process: convert images to greyscale, conditionally
     downsamples images, flatten images into row vector of pixel intensities,
-    and save row vector to intermediate csv.
+    and save row vector to intermediate csv, or, if output_format is 'npy', to
+    an intermediate binary file of uint8 pixels with a separate metadata
+    array. If out_queue is set, no intermediate files are written; batches of
+    row vectors are put on out_queue instead, followed by None.
 
     Args:
         i: Process index.
+        work_queue: Queue of image file paths shared by all processes.
         out_dir: Directory in which to create intermediate files and final
                  images.csv file.
         debug: If true, preserves intermediate image tiles.
         downsample_size: Side length of downsampled square images measured in
                          pixels. If set, images are downsampled before being
                          flattened.
+        output_format: Format of intermediate files, 'csv' or 'npy'.
+        out_queue: Queue on which to put batches of flattened images, as
+                   tuples of a uint8 pixel matrix and a list of metadata.
+        grey_dir: Directory of decoded greyscale images.
+        draft: If true, JPEG files are decoded at reduced scale.
 
     Raises:
         EnvironemtError: Problem creating csv file.
     """
 
     # local constants
-    process_name = multiprocessing.current_process().name
+    process_name = worker_name()
     chunk_dir = out_dir + os.sep + '_chunk_dir' + str(i)
-    image_type_list = ['JPG', 'JPEG', 'PNG', 'BMP', 'TIFF']
-
-    # open intermediate csv for writing flattened images
+    batch_size = 256
+    meta_list = []
+    pixel_list = []
+    draft_size = None
+    if draft:
+        draft_size = downsample_size
+
+    # open intermediate csv (or binary file) for writing flattened images
     out_csv_name = chunk_dir + os.sep + 'images' + str(i) + '.csv'
+    if output_format == 'npy':
+        out_csv_name = chunk_dir + os.sep + 'images' + str(i) + '.bin'
     try:
-        if os.path.exists(out_csv_name):
-            shutil.rmtree(out_csv_name, ignore_errors=True)
-        o = open(out_csv_name, 'wb')
-        wr = csv.writer(o)
+        if out_queue is None:
+            if os.path.exists(out_csv_name):
+                shutil.rmtree(out_csv_name, ignore_errors=True)
+            o = open(out_csv_name, 'wb')
+            wr = csv.writer(o)
     except EnvironmentError as exception_:
         print exception_
         print 'Failed to create ' + out_csv_name + '!'
         sys.exit(-1)
 
 
-    # loop through images in chunk dir
-    file_list = [name for name in os.listdir(chunk_dir)\
-                    if name.split('.')[-1].upper() in image_type_list]
-
-    for name in file_list:
+    # loop through images in work_queue
+    for chunk_file in iter(work_queue.get, None):
 
+        # convert to greyscale
+        name, im_array = open_greyscale(chunk_file, grey_dir, None,\
+                                        draft_size)
         print process_name + ': processing ' + name + ' ...'
-        chunk_file = chunk_dir + os.sep + name
-        
-        # convert to greyscale        
-        im = Image.open(chunk_file).convert('L')
 
         # conditionally downsample
-        if downsample_size != None:
-            tile = im.resize((downsample_size, downsample_size),\
-                              Image.ANTIALIAS)
+        tile = downsample_image(im_array, downsample_size)
 
-        # conditionally save tiles                                
+        # conditionally save tiles
         if debug:
             tile_fname = os.path.join(chunk_dir, 'tile.%s.png' % (name))
-            tile.save(tile_fname, "PNG")
+            Image.fromarray(tile).save(tile_fname, "PNG")
+
+        # put batches of pixels and metadata on out_queue
+        if out_queue is not None:
+            pixel_list.append(tile.flatten())
+            meta_list.append((name,))
+            if len(meta_list) == batch_size:
+                out_queue.put((np.vstack(pixel_list), meta_list))
+                pixel_list, meta_list = [], []
+            continue
+
+        # save pixels and metadata to intermediate binary files
+        if output_format == 'npy':
+            o.write(tile.tobytes())
+            meta_list.append((name,))
+            continue
 
         # flatten tiles into row vector of pixel intensities
-        tile_list = list(tile.getdata())
+        tile_list = tile.flatten().tolist()
         tile_list.extend([name])
 
         # save row vector to intermediate csv
         wr.writerow(tile_list)
 
+    if out_queue is not None:
+        if len(meta_list) > 0:
+            out_queue.put((np.vstack(pixel_list), meta_list))
+        out_queue.put(None)
+        print process_name + ': Done.'
+        return
+
     o.close()
+
+    if output_format == 'npy':
+        save_chunk_meta(chunk_dir + os.sep + 'images' + str(i) + '_meta.npy',\
+                        meta_list, ['orig_name'])
+
     print process_name + ': Done.'
     
 def reduce_join_csv(n_process, out_dir, debug, downsample_size):
 
     """ Creates out_dir/images.csv, writes csv header to images.csv, and
-    concatenates intermediate csv files into images.csv.
+    concatenates intermediate csv files in parallel into images.csv.
 
     Args:
         n_process: Number of processes specified by the user.
@@ -260,18 +430,17 @@ def reduce_join_csv(n_process, out_dir, debug, downsample_size):
     header = ['pixel_' + str(j) for j in range(0, downsample_size**2)]
     header.extend(['orig_name'])
     csv.writer(o).writerow(header)
+    o.close()
 
     # concatenate intermediate csv files into images.csv
-    for i in range(0, n_process):
-        chunk_dir = out_dir + os.sep + '_chunk_dir' + str(i)
-        in_csv_name = chunk_dir + os.sep + 'images' + str(i) + '.csv'
-        with open(in_csv_name) as n:
-            for line in n:
-                o.write(line)
-        if not debug:
-            shutil.rmtree(chunk_dir, ignore_errors=True)
+    in_csv_list = [out_dir + os.sep + '_chunk_dir' + str(i) + os.sep +\
+                    'images' + str(i) + '.csv' for i in range(0, n_process)]
+    concat_files(n_process, in_csv_list, out_csv_name)
 
-    o.close()
+    if not debug:
+        for i in range(0, n_process):
+            chunk_dir = out_dir + os.sep + '_chunk_dir' + str(i)
+            shutil.rmtree(chunk_dir, ignore_errors=True)
 
 def main(argv):
 
@@ -290,12 +459,20 @@ def main(argv):
     in_dir = ''
     out_dir = ''
     debug = False
+    copy_files = False
+    output_format = 'csv'
+    stream = False
+    cache_dir = None
+    cache_size = 2048
+    incremental = False
+    backend = 'process'
     downsample_size = 25
+    draft = False
 
     # parse command line args and update dependent args
 
     try:
-        opts, _ = getopt.getopt(argv, "p:i:o:g:d:h")
+        opts, _ = getopt.getopt(argv, "p:i:o:g:c:f:m:d:r:k:z:u:b:h")
         for opt, arg in opts:
             if opt == '-p':
                 n_process = int(arg)
@@ -305,8 +482,24 @@ def main(argv):
                 out_dir = arg
             elif opt == '-g':
                 debug = ast.literal_eval(arg)
+            elif opt == '-c':
+                copy_files = ast.literal_eval(arg)
+            elif opt == '-f':
+                output_format = arg.lower()
+            elif opt == '-m':
+                stream = ast.literal_eval(arg)
+            elif opt == '-k':
+                cache_dir = arg
+            elif opt == '-z':
+                cache_size = int(arg)
+            elif opt == '-u':
+                incremental = ast.literal_eval(arg)
+            elif opt == '-b':
+                backend = arg.lower()
             elif opt == '-d':
                 downsample_size = int(arg)
+            elif opt == '-r':
+                draft = ast.literal_eval(arg)
             elif opt == '-h':
                 print 'Example usage: python threaded_tile.py -i <input directory> -o <output directory> -d <downsample size>'
                 sys.exit(0)
@@ -323,42 +516,121 @@ def main(argv):
         print 'Error: enter value for output directory (-o).'
         raise Exception
 
+    if output_format not in ['csv', 'npy']:
+        print 'Error: enter csv or npy for output format (-f).'
+        raise Exception
+
+    if backend not in ['process', 'thread', 'hybrid']:
+        print 'Error: enter process, thread or hybrid for backend (-b).'
+        raise Exception
+
     print '-------------------------------------------------------------------'
     print 'Proceeding with options: '
     print 'Processes (-p)           = %s' % (n_process)
     print 'Input directory (i)      = %s' % (in_dir)
     print 'Output directory (-o)    = %s' % (out_dir)
     print 'Debug (-g)               = %s' % (debug)
+    print 'Copy files (-c)          = %s' % (copy_files)
+    print 'Output format (-f)       = %s' % (output_format)
+    print 'Stream (-m)              = %s' % (stream)
+    print 'Cache directory (-k)     = %s' % (cache_dir)
+    print 'Cache size (-z)          = %s' % (cache_size)
+    print 'Incremental (-u)         = %s' % (incremental)
+    print 'Backend (-b)             = %s' % (backend)
     print 'Downsample size (-d)     = %s' % (downsample_size)
+    print 'Draft (-r)               = %s' % (draft)
 
     # start execution timer
 
     bigtic = time.time()
-
-    # init chunk directory structure and copy chunks of files
+    draft_size = None
+    if draft:
+        draft_size = downsample_size
+
+    # conditionally find new or modified images, otherwise remove manifest of
+    # earlier incremental run
+
+    name_list = None
+    drop_set = None
+    if incremental:
+        parameters = {'downsample_size': downsample_size,\
+                      'draft': draft,\
+                      'output_format': output_format}
+        out_name_list = ['images.csv']
+        if output_format == 'npy':
+            out_name_list = ['images.npy', 'images_meta.npy',\
+                             'images.schema.json']
+        name_list, drop_set, file_dict = find_changed_images(in_dir, out_dir,\
+            parameters, out_name_list)
+        if len(name_list) == 0 and drop_set != None and len(drop_set) == 0:
+            print 'No new, modified or removed images.'
+            return
+    elif os.path.exists(out_dir + os.sep + 'manifest.json'):
+        os.remove(out_dir + os.sep + 'manifest.json')
+
+    # init chunk directory structure and assign (or copy) chunks of files
 
     create_out_dirs(n_process, out_dir)
-    chunk_files(n_process, in_dir, out_dir)
+    chunk_list = chunk_files(n_process, in_dir, out_dir, copy_files,\
+                             name_list)
+
+    # init persistent cache of decoded greyscale images, or, for the hybrid
+    # backend, directory of decoded greyscale images shared by all stages
+
+    grey_dir = cache_dir
+    if cache_dir == None and backend == 'hybrid':
+        grey_dir = out_dir + os.sep + '_grey_dir'
+    if grey_dir != None and not os.path.exists(grey_dir):
+        try:
+            os.makedirs(grey_dir)
+        except EnvironmentError as exception_:
+            print exception_
+            print 'Failed to create ' + grey_dir + '!'
+            sys.exit(-1)
+
+    # conditionally decode images to greyscale in threads first, so that the
+    # processes of the downsampling stage memory map decoded images
+
+    if backend == 'hybrid':
+        print '-------------------------------------------------------------------'
+        print 'Decoding images ... '
+        tic = time.time()
+        work_queue = queue_files(n_process, chunk_list, 'thread')
+        try:
+            threads = start_workers(n_process, 'thread', map_decode,\
+                                    (work_queue, grey_dir, draft_size))
+            join_workers(threads)
+            print 'Images decoded in %.2f s.' % (time.time()-tic)
+        except BaseException as exception_:
+            print exception_
+            print 'ERROR: Could not decode images.'
+            print sys.exc_info()
+            exit(-1)
 
     # multiprocessing map/reduce scheme to execute image manipulation tasks on
-    # chunks of image files in parallel
+    # image files in parallel, each process taking files from a shared queue
 
     # tile images using multiprocessing
-    # store in temporary files
+    # store in temporary files, or stream to final output file
 
     print '-------------------------------------------------------------------'
     print 'Tiling images ... '
     tic = time.time()
-    processes = []
+    work_queue = queue_files(n_process, chunk_list, backend)
+    out_queue = None
+    if stream:
+        out_queue = Queue()
+        if backend == 'thread':
+            out_queue = ThreadQueue()
     try:
-        for i in range(0, int(n_process)):
-            process_name = 'Process_' + str(i)
-            process = Process(target=map_downsample, name=process_name,\
-            args=(i, out_dir, debug, downsample_size,))
-            process.start()
-            processes.append(process)
-        for process_ in processes:
-            process_.join()
+        processes = start_workers(n_process, backend, map_downsample,\
+            (work_queue, out_dir, debug, downsample_size, output_format,\
+             out_queue, grey_dir, draft))
+        if stream:
+            reduce_stream(iter_batches(n_process, out_queue, processes),\
+                          out_dir, 'images', debug, downsample_size,\
+                          output_format, ['orig_name'])
+        join_workers(processes)
         print 'Completed tiling images in %.2f s.' % (time.time()-tic)
     except BaseException as exception_:
         print exception_
@@ -366,13 +638,41 @@ def main(argv):
         print sys.exc_info()
         exit(-1)
 
-    # reduce temporary files into a single large csv
+    # trim persistent cache only once all stages have read the decoded images
+
+    if cache_dir != None:
+        evict_greyscale_cache(cache_dir, cache_size, None)
+
+    # reduce temporary files into a single large csv (or npy)
+
+    if not stream:
+        print '---------------------------------------------------------------'
+        print 'Combining tile ' + output_format + ' files ... '
+        if output_format == 'npy':
+            reduce_join_npy(n_process, out_dir, 'images', debug,\
+                            downsample_size)
+        else:
+            reduce_join_csv(n_process, out_dir, debug, downsample_size)
+        print 'Done.'
+        print 'Files combined in %.2f s.' % (time.time()-tic)
+
+    # conditionally merge output of earlier run and write manifest
+
+    if incremental:
+        if drop_set != None:
+            print '---------------------------------------------------------------'
+            print 'Merging output of earlier run ... '
+            if output_format == 'npy':
+                merge_previous_npy(out_dir, 'images', drop_set,\
+                                   downsample_size)
+            else:
+                merge_previous_csv(out_dir, 'images.csv', drop_set, -1)
+            shutil.rmtree(out_dir + os.sep + '_previous', ignore_errors=True)
+            print 'Done.'
+        save_manifest(out_dir, parameters, file_dict)
 
-    print '-------------------------------------------------------------------'
-    print 'Combining tile csv files ... '
-    reduce_join_csv(n_process, out_dir, debug, downsample_size)
-    print 'Done.'
-    print 'Csv files combined in %.2f s.' % (time.time()-tic)
+    if not debug:
+        shutil.rmtree(out_dir + os.sep + '_grey_dir', ignore_errors=True)
 
     print '-------------------------------------------------------------------'
     print 'All tasks completed in %.2f s.' % (time.time()-bigtic)
@@ -22,7 +22,7 @@ limitations under the License.
 Script using Python multiprocessing and PIL to complete independent image
 preprocessing tasks.
 
-Images are copied into n_process seperate folders and converted to greyscale.
+Images are split into n_process chunks and converted to greyscale.
 Original, full size images are coverted into x,y,z contours and written to csv.
 These countours serve as the background over which to lie interesting patches.
 Images are then tiled. Tiling can lead to the learning of translation-invariant
@@ -44,15 +44,55 @@ n_process: (-p) Number of processes to use; the script will create this many
 in_dir: (-i) Directory in which input images are located. This directory should
         contain only image files of type JPG, PNG, BMP or TIFF. The files must
         also have standard file extensions to be recognized by the script.
-        Files will be copied into their respective chunk directories before
-        being tiled, (and/or downsampled,) flattened, and converted to csv.
+        Files are read directly from in_dir by each process and are only
+        copied into their respective chunk directories when -c is set.
 
 out_dir: (-o) Parent directory in which the sub-directories for each chunk of
          image files will be created. A large number temporary files will be
-         created in out_dir.
+         created in out_dir. Each image is decoded to greyscale only once,
+         and the same worker then converts it to contours and tiles it, while
+         other workers convert and tile other images. Unless the thread
+         backend is used, decoded images are saved to out_dir/_grey_dir (or
+         cache_dir) and memory mapped from there, so a worker does not hold
+         its own copy of a decoded image while converting and tiling it;
+         this costs one write of each decoded image.
 
 debug: (-g) Leaves temporary files in out_dir. (default=False)
 
+copy_files: (-c) Copies image files into their respective chunk directories
+            before they are processed, rather than reading them directly from
+            in_dir. (default=False)
+
+output_format: (-f) Format of the final output, csv or npy. The npy format
+               writes the uint8 pixel intensities of each patch as a row of
+               patches.npy, the orig_name, x, y, size and angle of each patch
+               as a row of patches_meta.npy, and a description of both files
+               to patches.schema.json. Original image contours are likewise
+               written as x, y, z rows of the int32 matrix originals.npy, with
+               the orig_name, width, height, contour step, number of points
+               and first row of each image in originals_meta.npy and a
+               description in originals.schema.json.
+               All .npy files can be loaded (or memory mapped) with numpy.load
+               without parsing. (default=csv)
+
+stream: (-m) Streams batches of flattened patches from each process to a
+        single writer, which writes them directly into the final output
+        file. No intermediate patches files are written. (default=False)
+
+contour_step: (-e) Only every contour_step-th pixel in each direction of the
+              original images is written to originals.csv, reducing the size
+              of originals.csv, and the memory needed to plot it, by a factor
+              of about contour_step*contour_step. x and y values remain in
+              original pixel coordinates. (default=1)
+
+contour_points: (-n) Approximate maximum number of contour points written to
+                originals.csv for each original image. If set, contour_step is
+                increased for each image as needed. (default=None)
+
+intensity_threshold: (-l) Pixels with a greyscale intensity below this value,
+                     i.e. with a z value above 255 - intensity_threshold, are
+                     not written to originals.csv. (default=None)
+
 tile_size: (-t) Side length of square image patches measured in pixels. If
            downsample_size is set to None, this will be the final side length
            of the square image patches used for analysis and each row vector of
@@ -80,6 +120,50 @@ variance_threshold: (-v) The standard deviation above which an image will be
                     dark, or plain white images from being included in the
                     analysis. (default=tile_size/10)
 
+cache_dir: (-k) Directory in which decoded greyscale images are kept across
+           runs, as memory-mappable .npy files keyed by the MD5 hash of each
+           image file. Runs over the same input images with different
+           settings then skip decoding. (default=None)
+
+cache_size: (-z) Size limit of cache_dir measured in megabytes. At the end
+            of each run, once all stages have read the decoded images, the
+            least recently used images are removed from cache_dir while it
+            is larger than cache_size. (default=2048)
+
+incremental: (-u) Processes only the images that were added to or modified in
+             in_dir since the last incremental run with the same options, and
+             merges their rows into the existing output files, dropping the
+             rows of modified or removed images. Processed images and options
+             are recorded in out_dir/manifest.json. (default=False)
+
+patch_store: (-x) Sorts the rows of patches.npy and patches_meta.npy by
+             orig_name, x, y, size and angle, so that the output directory
+             can be opened as a memory-mapped patch store with
+             patch_store.py. The patches of an image, or of a region of an
+             image, are then found by binary search and sliced without
+             copying. Requires npy output format (-f). (default=False)
+
+dedup: (-q) Drops patches whose average hash, a compact perceptual hash of
+       the (downsampled) patch, equals that of a patch kept earlier: none,
+       image or global. With image, duplicates are dropped within each
+       image. With global, all workers share one set of hashes, so
+       duplicates are dropped across images; which copy is kept then depends
+       on the order in which workers reach them. Global cannot be combined
+       with incremental runs (-u), which would drop duplicates only among
+       the new or modified images. The number of dropped patches of each
+       image is printed. (default=none)
+
+backend: (-b) How images are contoured and tiled by n_process workers:
+         process, thread or hybrid. With process, each worker is a separate
+         process, which memory maps the images it decodes from
+         out_dir/_grey_dir (or cache_dir). With thread, workers are threads
+         of a single process, which need no copies of the images they work
+         on and keep them in memory; Pillow decoding and NumPy filtering and
+         resampling release the GIL, so threads still run in parallel. With
+         hybrid, images are first decoded to out_dir/_grey_dir (or
+         cache_dir) by threads, then contoured and tiled by processes, which
+         memory map the decoded images. (default=process)
+
 Run threaded_tile.py from an IDE by setting constants in main OR by the command
 line. Example command line usage:
 
@@ -92,14 +176,23 @@ $ python threaded_tile.py -i test_in -o test_out -g True -t 400
 import ast
 import csv
 import getopt
+import glob
+import itertools
 import multiprocessing
 import numpy as np
 import os
 import shutil
 import sys
 import time
-from multiprocessing import Process
+from multiprocessing import Process, Queue
+from Queue import Queue as ThreadQueue
 from PIL import Image
+from threaded_common import concat_files, contour_csv_lines,\
+    evict_greyscale_cache, find_changed_images, image_names, is_duplicate,\
+    iter_batches, join_workers, map_decode, merge_previous_csv,\
+    merge_previous_npy, merge_previous_original_npy, open_greyscale,\
+    queue_files, reduce_join_npy, reduce_join_original_npy, reduce_stream,\
+    save_chunk_meta, save_manifest, sort_npy, start_workers, worker_name
 
 def create_out_dirs(n_process, out_dir):
 
@@ -134,16 +227,25 @@ def create_out_dirs(n_process, out_dir):
 
     print 'Done.'
 
-def chunk_files(n_process, in_dir, out_dir):
+def chunk_files(n_process, in_dir, out_dir, copy_files=False, name_list=None):
 
-    """ Separates the image in in_dir into n_process roughly equal chunks of
-    files, each in a separate directory created by create_out_dirs.
+    """ Separates the images in in_dir into n_process roughly equal chunks of
+    files. By default no files are copied; each chunk is a list of paths into
+    in_dir that the processes read directly. If copy_files is set, the
+    images are also copied into the separate directories created by
+    create_out_dirs and the chunks refer to the copies.
 
     Args:
         n_process: Number of processes specified by the user.
         in_dir: Directory in which original image files are located.
         out_dir: Directory in which to create intermediate files and final
                  patches.csv file.
+        copy_files: If true, copies image files into chunk directories.
+        name_list: Names of the image files in in_dir to chunk. By default,
+                   all image files in in_dir are chunked.
+
+    Returns:
+        List of n_process lists of image file paths.
 
     Raises:
         EnvironemtError: Problem copying image files.
@@ -155,16 +257,23 @@ def chunk_files(n_process, in_dir, out_dir):
     # local constants
 
     check_point_value = 1000
-    image_type_list = ['JPG', 'JPEG', 'PNG', 'BMP', 'TIFF']
 
-     # copy files
+    # assign files to chunks, conditionally copy files
+
+    file_list = name_list
+    if file_list == None:
+        file_list = image_names(in_dir)
 
-    file_list = [name for name in os.listdir(in_dir)\
-                    if name.split('.')[-1].upper() in image_type_list]
+    chunk_list = [[] for _ in range(0, int(n_process))]
 
     for i, name in enumerate(file_list):
 
         source_file = in_dir + os.sep + name
+
+        if not copy_files:
+            chunk_list[i % n_process].append(source_file)
+            continue
+
         chunk_outdir = out_dir + os.sep + '_chunk_dir' +\
             str(int(i % n_process))
         chunk_file = chunk_outdir + os.sep + name
@@ -179,20 +288,41 @@ def chunk_files(n_process, in_dir, out_dir):
             print 'Failed to copy' + name + '!'
             sys.exit(-1)
 
+        chunk_list[i % n_process].append(chunk_file)
+
         if i % check_point_value == 0 and i != 0:
             print 'Processing file %i ...' % (i)
 
     print 'Done.'
 
-def map_convert_originals(i, out_dir):
+    return chunk_list
 
-    """ Write original image file to csv as x,y,z contours. These countours are
-    used as the background over which to lie interesting patches.
+def convert_original(name, im_array, chunk_dir, output_format='csv',
+                     contour_step=1, contour_points=None,
+                     intensity_threshold=None):
+
+    """ Write original image to csv as x,y,z contours. These countours are
+    used as the background over which to lie interesting patches. Contours are
+    formatted in bands of rows, each with a single vectorized call. If
+    output_format is 'npy', contours are instead written to an intermediate
+    binary file of int32 x,y,z rows. Contours can be written at reduced
+    resolution, on a grid of every contour_step-th pixel, and pixels below an
+    intensity threshold can be skipped.
 
     Args:
-        i: Process index.
-        out_dir: Directory in which to create intermediate files and final
-                 originals.csv file.
+        name: Name of the original image file.
+        im_array: Greyscale image as 2-D numpy array.
+        chunk_dir: Directory in which to create intermediate files.
+        output_format: Format of intermediate files, 'csv' or 'npy'.
+        contour_step: Distance in pixels between contour points in each
+                      direction.
+        contour_points: Approximate maximum number of contour points for each
+                        image. If set, contour_step is increased as needed.
+        intensity_threshold: Pixel intensity below which pixels are skipped.
+
+    Returns:
+        Tuple of the image name, width, height, contour step and number of
+        contour points written.
 
     Raises:
         EnvironemtError: Problem creating csv file.
@@ -200,49 +330,62 @@ def map_convert_originals(i, out_dir):
 
     # local constants
 
-    process_name = multiprocessing.current_process().name
-    chunk_dir = out_dir + os.sep + '_chunk_dir' + str(i)
-    image_type_list = ['JPG', 'JPEG', 'PNG', 'BMP', 'TIFF']
+    band_pixels = 2**20
 
-    # cycle through original images in chunk_dir and convert to csv using
-    # pandas
+    out_csv_name = chunk_dir + os.sep + 'orig.' + name + '.csv'
+    if output_format == 'npy':
+        out_csv_name = chunk_dir + os.sep + 'orig.' + name + '.bin'
+    try:
+        if os.path.exists(out_csv_name):
+            os.remove(out_csv_name)
+        o = open(out_csv_name, 'wb')
+    except EnvironmentError as exception_:
+        print exception_
+        print 'Failed to create ' + out_csv_name + '!'
+        sys.exit(-1)
 
-    file_list = [name for name in os.listdir(chunk_dir)\
-                    if name.split('.')[-1].upper() in image_type_list]
+    h, w = im_array.shape
 
-    for name in file_list:
+    # conditionally increase step to meet contour_points
 
-        print process_name + ': Converting ' + name + ' to csv ...'
-        chunk_file = chunk_dir + os.sep + name
+    step = contour_step
+    if contour_points != None:
+        step = max(step, int(np.ceil(np.sqrt(float(w*h)/contour_points))))
+    grid = im_array[::step, ::step]
+    grid_x = np.arange(0, w, step) + 1
+    band_rows = max(1, band_pixels/len(grid_x))
+    n_points = 0
 
-        out_csv_name = chunk_dir + os.sep + 'orig.' + name + '.csv'
-        try:
-            if os.path.exists(out_csv_name):
-                os.remove(out_csv_name, ignore_errors=True)
-            o = open(out_csv_name, 'wb')
-        except EnvironmentError as exception_:
-            print exception_
-            print 'Failed to create ' + out_csv_name + '!'
-            sys.exit(-1)
+    # write contours of each band of grid rows, top row has y = h
 
-        im = Image.open(chunk_file).convert('L')
-        w, h = im.size
-        x = np.tile(np.arange(w), h).T + 1
-        y = np.repeat(np.arange(h-1, -1, -1), w).T + 1
-        z = 255-np.asarray(im.getdata()).T
+    for top in range(0, len(grid), band_rows):
 
-        wr = csv.writer(o)
-        for i in range(0, w*h):
-            wr.writerow([x[i], y[i], z[i], name])
+        band = grid[top:top + band_rows]
+        x = np.tile(grid_x, len(band))
+        y = np.repeat(h - (top + np.arange(len(band)))*step, len(grid_x))
+        z = 255 - band.ravel().astype(np.int32)
 
-        o.close()
+        # conditionally skip dark pixels
+        if intensity_threshold != None:
+            keep = band.ravel() >= intensity_threshold
+            x, y, z = x[keep], y[keep], z[keep]
+            if len(x) == 0:
+                continue
+        n_points += len(x)
 
-    print process_name + ': Done.'
+        if output_format == 'npy':
+            o.write(np.column_stack((x, y, z)).astype('<i4').tobytes())
+        else:
+            o.write(contour_csv_lines(x, y, z, name))
+
+    o.close()
+
+    return name, w, h, step, n_points
 
 def reduce_join_original_csv(n_process, out_dir, debug):
 
     """ Creates out_dir/originals.csv, writes csv header to originals.csv, and
-    concatenates intermediate csv files into orginals.csv.
+    concatenates intermediate csv files in parallel into orginals.csv.
 
     Args:
         n_process: Number of processes specified by the user.
@@ -271,9 +414,11 @@ def reduce_join_original_csv(n_process, out_dir, debug):
     header = ['x', 'y', 'z', 'orig_name']
 
     csv.writer(o).writerow(header)
+    o.close()
 
     # concatenate intermediate csv files into originals.csv
 
+    in_csv_list = []
     for i in range(0, n_process):
 
         chunk_dir = out_dir + os.sep + '_chunk_dir' + str(i)
@@ -282,26 +427,335 @@ def reduce_join_original_csv(n_process, out_dir, debug):
                     if name.split('.')[0].upper() == 'ORIG']
 
         for name in file_list:
+            in_csv_list.append(chunk_dir + os.sep + name)
 
-            in_csv_name = chunk_dir + os.sep + name
-            with open(in_csv_name) as n:
-                for line in n:
-                    o.write(line)
+    concat_files(n_process, in_csv_list, out_csv_name)
 
-    o.close()
+def summed_area_tables(im_array):
+
+    """ Creates summed-area tables of pixel intensities and squared pixel
+    intensities. Element [y, x] of each table holds the sum over all pixels
+    above and to the left of pixel (x, y), so the sum over any rectangle in
+    the image can be read from four elements.
+
+    Args:
+        im_array: Greyscale image as 2-D numpy array.
+
+    Returns:
+        Tuple of summed-area tables of pixel intensities and squared pixel
+        intensities, each one row and column larger than im_array.
+    """
+
+    h, w = im_array.shape
+    sat = np.zeros((h + 1, w + 1), dtype=np.int64)
+    sat_sq = np.zeros((h + 1, w + 1), dtype=np.int64)
+    sat[1:, 1:] = im_array.cumsum(axis=0, dtype=np.int64).cumsum(axis=1)
+    sat_sq[1:, 1:] = (im_array.astype(np.int64)**2).cumsum(axis=0)\
+                        .cumsum(axis=1)
+
+    return sat, sat_sq
+
+def patch_std(sat, sat_sq, left, upper, right, lower):
+
+    """ Calculates the standard deviation of pixel intensities of rectangular
+    patches in constant time per patch from summed-area tables. Patch bounds
+    follow the same convention as the PIL crop box and may be scalars or numpy
+    arrays.
+
+    Args:
+        sat: Summed-area table of pixel intensities.
+        sat_sq: Summed-area table of squared pixel intensities.
+        left: Left x value(s) of the patch(es).
+        upper: Upper y value(s) of the patch(es).
+        right: Right x value(s) of the patch(es), exclusive.
+        lower: Lower y value(s) of the patch(es), exclusive.
+
+    Returns:
+        Standard deviation(s) of pixel intensities of the patch(es).
+    """
+
+    def rect_sum(table):
+        return (table[lower, right] - table[upper, right] -\
+                table[lower, left] + table[upper, left]).astype(np.float64)
+
+    n = np.asarray((right - left) * (lower - upper), dtype=np.float64)
+    total, total_sq = rect_sum(sat), rect_sum(sat_sq)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = (n * total_sq - total * total) / (n * n)
+
+    return np.sqrt(np.maximum(var, 0))
+
+def tile_offsets(length, tile_size, stride_length):
+
+    """ Calculates the offsets of patches along one side of an image. Patches
+    start every stride_length pixels. The first patch that reaches the edge of
+    the image is moved back to end exactly at the edge and no patches are
+    started after it. If stride_length is larger than tile_size, no patch may
+    reach the edge.
+
+    Args:
+        length: Width or height of the image measured in pixels.
+        tile_size: Side length of square image patches measured in pixels.
+        stride_length: Number of pixels between each patch.
+
+    Returns:
+        Numpy array of patch offsets along one side of the image.
+    """
+
+    offsets = np.arange(0, length, stride_length)
+    edge = np.nonzero(offsets + tile_size >= length)[0]
+    if len(edge) > 0:
+        offsets = offsets[:edge[0] + 1]
+        offsets[-1] = length - tile_size
+
+    return offsets
+
+def extract_patches(im_array, tile_size, stride_length, variance_threshold):
+
+    """ Finds all patches of an image with sufficient pixel intensity
+    variance. All possible patches of the image are represented as a strided
+    view of the image array, so no patch is copied until it is selected. The
+    image is worked through in horizontal bands, each holding one or more rows
+    of patches. The standard deviations of all patches in a band are
+    calculated at once from int64 summed-area tables of the band, so rejected
+    patches are never read from the image and the tables, like the float64
+    standard deviations of a band, are bounded by the band size however large
+    the image is. The image itself is not decoded in bands: im_array holds
+    the whole greyscale image, in memory or memory mapped. Patches and their
+    order do not depend on the band size.
+
+    Args:
+        im_array: Greyscale image as 2-D numpy array.
+        tile_size: Side length of square image patches measured in pixels.
+        stride_length: Number of pixels between each patch.
+        variance_threshold: The standard deviation above which a patch will be
+                            returned.
+
+    Yields:
+        Tuples of upper-lefthand x and y values and the 2-D numpy array of
+        each patch with sufficient variance.
+    """
+
+    # local constants
+
+    band_pixels = 2**22
+
+    h, w = im_array.shape
+
+    # image smaller than a patch has no patches
+
+    if h < tile_size or w < tile_size:
+        return
+
+    # check stride_length
+
+    stride_length = max(1, min(stride_length, min(w, h) - tile_size))
+
+    # view of every tile_size x tile_size window in the image
+
+    windows = np.lib.stride_tricks.as_strided(im_array,\
+        shape=(h - tile_size + 1, w - tile_size + 1, tile_size, tile_size),\
+        strides=im_array.strides * 2)
+
+    x_offsets = tile_offsets(w, tile_size, stride_length)
+    y_offsets = tile_offsets(h, tile_size, stride_length)
+
+    # number of patch rows in each band, at least one
+
+    band_offsets = max(1, (band_pixels/w - tile_size)/stride_length + 1)
+
+    left = x_offsets[np.newaxis, :]
+    for start in range(0, len(y_offsets), band_offsets):
+
+        band_y_offsets = y_offsets[start:start + band_offsets]
+        top = band_y_offsets[0]
+        band = im_array[top:band_y_offsets[-1] + tile_size]
+
+        sat, sat_sq = summed_area_tables(band)
+        upper = band_y_offsets[:, np.newaxis] - top
+        std = patch_std(sat, sat_sq, left, upper, left + tile_size,\
+                        upper + tile_size)
+
+        for k, j in zip(*np.nonzero(std > variance_threshold)):
+            y_, x_ = band_y_offsets[k], x_offsets[j]
+            yield x_, y_, np.ascontiguousarray(windows[y_, x_])
+
+def antialias_kernel(in_size, out_size):
+
+    """ Creates the matrix of Lanczos resampling weights that PIL uses to
+    resize one axis of an image with Image.ANTIALIAS, so that resizing square
+    patches becomes two matrix products.
+
+    Args:
+        in_size: Side length of the input patches measured in pixels.
+        out_size: Side length of the output patches measured in pixels.
+
+    Returns:
+        out_size x in_size float32 numpy array of normalized weights.
+    """
+
+    # local constants
+
+    lanczos_support = 3.0
+
+    scale = in_size/float(out_size)
+    filter_scale = max(scale, 1.0)
+    support = lanczos_support*filter_scale
+
+    kernel = np.zeros((out_size, in_size))
+    for i in range(0, out_size):
+        center = (i + 0.5)*scale
+        x_min = max(int(center - support + 0.5), 0)
+        x_max = min(int(center + support + 0.5), in_size)
+        x = (np.arange(x_min, x_max) - center + 0.5)/filter_scale
+        weights = np.sinc(x)*np.sinc(x/lanczos_support)
+        weights[np.abs(x) >= lanczos_support] = 0
+        kernel[i, x_min:x_max] = weights/weights.sum()
+
+    return kernel.astype(np.float32)
+
+def resample_patches(patches, kernel):
+
+    """ Resamples a stack of square patches at once with a separable kernel,
+    first along rows and then along columns, rounding to uint8 after each pass
+    like PIL does.
+
+    Args:
+        patches: n x in_size x in_size numpy array of patches.
+        kernel: out_size x in_size kernel from antialias_kernel.
+
+    Returns:
+        n x out_size x out_size uint8 numpy array of resampled patches.
+    """
+
+    rows = np.matmul(patches.astype(np.float32), kernel.T)
+    rows = np.clip(np.rint(rows), 0, 255)
+
+    return np.clip(np.rint(np.matmul(kernel, rows)), 0, 255).astype(np.uint8)
 
+def make_tiles(im_array, tile_size, downsample_size, stride_length,
+               variance_threshold):
 
-def map_make_tiles(i, out_dir, debug, tile_size, downsample_size,
-                   stride_length, variance_threshold):
+    """ Creates patches with sufficient pixel intensity variance from an
+    image and conditionally downsamples them. Patches are downsampled in
+    batches with resample_patches, which matches Image.ANTIALIAS to within one
+    intensity level: at least 99.9% of pixels of the sample images are
+    identical.
 
-    """ In each process: creates patches from each file, conditionally
-    downsamples patches, flattens patches into row vector of pixel intensities,
-    and saves row vector to intermediate csv.
+    Args:
+        im_array: Greyscale image as 2-D numpy array.
+        tile_size: Side length of square image patches measured in pixels.
+        downsample_size: Side length of downsampled square image patches
+                         measured in pixels. If set, image patches are
+                         downsampled.
+        stride_length: Number of pixels between each patch.
+        variance_threshold: The standard deviation above which a patch will be
+                            kept.
+
+    Yields:
+        Tuples of upper-lefthand x and y values and the 2-D uint8 numpy array
+        of each patch.
+    """
+
+    # local constants
+
+    batch_pixels = 2**22
+
+    patches = extract_patches(im_array, tile_size, stride_length,
+                              variance_threshold)
+
+    if downsample_size == None:
+        for x_, y_, tile in patches:
+            yield x_, y_, tile
+        return
+
+    # downsample batches of patches
+
+    kernel = antialias_kernel(tile_size, downsample_size)
+    batch_size = max(1, batch_pixels/(tile_size*tile_size))
+
+    while True:
+
+        batch = list(itertools.islice(patches, batch_size))
+        if len(batch) == 0:
+            break
+
+        tiles = resample_patches(np.array([tile for _, _, tile in batch]),\
+                                 kernel)
+        for (x_, y_, _), tile in zip(batch, tiles):
+            yield x_, y_, tile
+
+def iter_patches(images, tile_size, downsample_size=25, stride_length=None,
+                 variance_threshold=None, batch_size=256):
+
+    """ Lazily creates patches from images in the calling process, for use
+    from other Python code without writing any files. Defaults are the same
+    as for the command line.
 
     Args:
-        i: Process index.
+        images: Iterable of image file paths, or of tuples of an image name
+                and a PIL image or 2-D numpy array.
+        tile_size: Side length of square image patches measured in pixels.
+        downsample_size: Side length of downsampled square image patches
+                         measured in pixels. If set, image patches are
+                         downsampled.
+        stride_length: Number of pixels between each patch.
+                       (default=tile_size/2)
+        variance_threshold: The standard deviation above which a patch will be
+                            kept. (default=tile_size/10)
+        batch_size: Maximum number of patches in each batch.
+
+    Yields:
+        Tuples of a uint8 pixel matrix, with one flattened patch per row, and
+        a list of (orig_name, x, y, size, angle) metadata tuples, one per row.
+    """
+
+    if stride_length == None:
+        stride_length = int(tile_size/2)
+
+    if variance_threshold == None:
+        variance_threshold = int(tile_size/10)
+
+    pixel_list, meta_list = [], []
+
+    for image in images:
+
+        name, im_array = open_greyscale(image)
+
+        for x_, y_, tile in make_tiles(im_array, tile_size, downsample_size,
+                                       stride_length, variance_threshold):
+
+            pixel_list.append(tile.flatten())
+            meta_list.append((name, x_, y_, tile_size, 0))
+
+            if len(meta_list) == batch_size:
+                yield np.vstack(pixel_list), meta_list
+                pixel_list, meta_list = [], []
+
+    if len(meta_list) > 0:
+        yield np.vstack(pixel_list), meta_list
+
+def map_images(i, work_queue, out_dir, debug, tile_size, downsample_size,
+               stride_length, variance_threshold, output_format='csv',
+               contour_step=1, contour_points=None, intensity_threshold=None,
+               out_queue=None, grey_dir=None, dedup='none', shared_dict=None):
+
+    """ In each worker: takes one image at a time from work_queue, converts
+    it to contours with convert_original, then creates patches from it,
+    conditionally downsamples patches, flattens patches into row vector of
+    pixel intensities, and saves row vector to intermediate csv or, if
+    output_format is 'npy', to an intermediate binary file of uint8 pixels
+    with a separate metadata array. If out_queue is set, no intermediate
+    patches files are written; batches of row vectors are put on out_queue
+    instead, followed by None. The same workers run both stages for every
+    image, so one image is contoured while others are tiled, without a second
+    set of workers or a barrier between the stages.
+
+    Args:
+        i: Worker index.
+        work_queue: Queue of image file paths shared by all workers.
         out_dir: Directory in which to create intermediate files and final
-                 patches.csv file.
+                 originals.csv and patches.csv files.
         debug: If true, preserves intermediate image patches.
         tile_size: Side length of square image patches measured in pixels.
         downsample_size: Side length of downsampled square image patches
@@ -310,6 +764,20 @@ def map_make_tiles(i, out_dir, debug, tile_size, downsample_size,
         stride_length: Number of pixels between each patch.
         variance_threshold: The standard deviation above which an image will be
                             flattened and saved to patches.csv.
+        output_format: Format of intermediate files, 'csv' or 'npy'.
+        contour_step: Distance in pixels between contour points in each
+                      direction.
+        contour_points: Approximate maximum number of contour points for each
+                        image. If set, contour_step is increased as needed.
+        intensity_threshold: Pixel intensity below which pixels are not
+                             written to contours.
+        out_queue: Queue on which to put batches of flattened patches, as
+                   tuples of a uint8 pixel matrix and a list of metadata.
+        grey_dir: Directory of decoded greyscale images.
+        dedup: Drops patches with the same average hash as a patch kept
+               earlier: 'none', 'image' or 'global'.
+        shared_dict: Dict of the hashes seen by all workers, if dedup is
+                     'global'.
 
     Raises:
         EnvironemtError: Problem creating csv file.
@@ -317,97 +785,117 @@ def map_make_tiles(i, out_dir, debug, tile_size, downsample_size,
 
     # local constants
 
-    process_name = multiprocessing.current_process().name
+    process_name = worker_name()
+    seen_set = set()
     chunk_dir = out_dir + os.sep + '_chunk_dir' + str(i)
-    image_type_list = ['JPG', 'JPEG', 'PNG', 'BMP', 'TIFF']
+    batch_size = 256
+    orig_meta_list = []
+    meta_list = []
+    pixel_list = []
 
-    # open intermediate csv for writing flattened images
+    # open intermediate csv (or binary file) for writing flattened images
 
     out_csv_name = chunk_dir + os.sep + 'patches' + str(i) + '.csv'
+    if output_format == 'npy':
+        out_csv_name = chunk_dir + os.sep + 'patches' + str(i) + '.bin'
     try:
-        if os.path.exists(out_csv_name):
-            shutil.rmtree(out_csv_name, ignore_errors=True)
-        o = open(out_csv_name, 'wb')
-        wr = csv.writer(o)
+        if out_queue is None:
+            if os.path.exists(out_csv_name):
+                shutil.rmtree(out_csv_name, ignore_errors=True)
+            o = open(out_csv_name, 'wb')
+            wr = csv.writer(o)
     except EnvironmentError as exception_:
         print exception_
         print 'Failed to create ' + out_csv_name + '!'
         sys.exit(-1)
 
-    file_list = [name for name in os.listdir(chunk_dir)\
-                    if name.split('.')[-1].upper() in image_type_list]
+    for chunk_file in iter(work_queue.get, None):
 
-    for name in file_list:
+        name, im_array = open_greyscale(chunk_file, grey_dir)
 
-        print process_name + ': tiling ' + name + ' ...'
+        # convert original image to contours
 
-        chunk_file = chunk_dir + os.sep + name
-        im = Image.open(chunk_file).convert('L')
-        w, h = im.size
+        print process_name + ': Converting ' + name + ' to ' + output_format +\
+            ' ...'
+        orig_meta_list.append(convert_original(name, im_array, chunk_dir,\
+            output_format, contour_step, contour_points, intensity_threshold))
 
-        # check stride_length
+        print process_name + ': tiling ' + name + ' ...'
+        if dedup == 'image':
+            seen_set = set()
+        n_duplicate = 0
 
-        if stride_length > min(w, h) - tile_size:
-            stride_length = min(w, h) - tile_size
+        # create (and conditionally downsample) patches from each file
 
-        # create patches from each file
+        for x_, y_, tile in make_tiles(im_array, tile_size, downsample_size,
+                                       stride_length, variance_threshold):
 
-        reached_y_edge = False
-        for y in range(0, h, stride_length):
+            # conditionally drop nearly identical patches
 
-            y_ = y
-            if reached_y_edge:
+            if dedup != 'none' and\
+                    is_duplicate(tile, seen_set, shared_dict, i):
+                n_duplicate += 1
                 continue
-            else:
-                my = min(y + tile_size, h)
-                if my == h:
-                    y_ = h - tile_size
-                    reached_y_edge = True
 
-            reached_x_edge = False
-            for x in range(0, w, stride_length):
+            if debug:
+                tile_fname = os.path.join(chunk_dir,\
+                    'patch.%s.%d.%d.png' % (name, x_, y_))
+                Image.fromarray(tile).save(tile_fname, "PNG")
 
-                x_ = x
-                if reached_x_edge:
-                    continue
-                else:
-                    mx = min(x + tile_size, w)
-                    if mx == w:
-                        x_ = w - tile_size
-                        reached_x_edge = True
+            # put batches of pixels and metadata on out_queue
 
-                tile = im.crop((x_, y_, mx, my))
-                std = np.std(np.array(tile))
+            if out_queue is not None:
+                pixel_list.append(tile.flatten())
+                meta_list.append((name, x_, y_, tile_size, 0))
+                if len(meta_list) == batch_size:
+                    out_queue.put((np.vstack(pixel_list), meta_list))
+                    pixel_list, meta_list = [], []
+                continue
+
+            # save pixels and metadata to intermediate binary files
 
-                if std > variance_threshold:
+            if output_format == 'npy':
+                o.write(tile.tobytes())
+                meta_list.append((name, x_, y_, tile_size, 0))
+                continue
 
-                    # conditionally downsample patches
+            # flatten patches into row vector of pixel intensities
 
-                    if downsample_size != None:
-                        tile = tile.resize((downsample_size, downsample_size),\
-                                            Image.ANTIALIAS)
+            tile_list = tile.flatten().tolist()
+            tile_list.extend([name, x_, y_, tile_size, 0])
 
-                    if debug:
-                        tile_fname = os.path.join(chunk_dir,\
-                            'patch.%s.%d.%d.png' % (name, x_, y_))
-                        tile.save(tile_fname, "PNG")
+            # save row vector to intermediate csv
 
-                    # flatten patches into row vector of pixel intensities
+            wr.writerow(tile_list)
 
-                    tile_list = list(tile.getdata())
-                    tile_list.extend([name, x_, y_, tile_size, 0])
+        if dedup != 'none':
+            print process_name + ': dropped %d duplicate patches of %s.' %\
+                (n_duplicate, name)
 
-                    # save row vector to intermediate csv
+    if output_format == 'npy':
+        save_chunk_meta(chunk_dir + os.sep + 'orig' + str(i) + '_meta.npy',\
+                        orig_meta_list, ['orig_name', 'width', 'height',\
+                                         'step', 'points'])
 
-                    wr.writerow(tile_list)
+    if out_queue is not None:
+        if len(meta_list) > 0:
+            out_queue.put((np.vstack(pixel_list), meta_list))
+        out_queue.put(None)
+        print process_name + ': Done.'
+        return
 
     o.close()
+
+    if output_format == 'npy':
+        save_chunk_meta(chunk_dir + os.sep + 'patches' + str(i) + '_meta.npy',\
+                        meta_list, ['orig_name', 'x', 'y', 'size', 'angle'])
+
     print process_name + ': Done.'
 
 def reduce_join_csv(n_process, out_dir, debug, tile_size):
 
     """ Creates out_dir/patches.csv, writes csv header to patches.csv, and
-    concatenates intermediate csv files into patches.csv.
+    concatenates intermediate csv files in parallel into patches.csv.
 
     Args:
         n_process: Number of processes specified by the user.
@@ -438,19 +926,18 @@ def reduce_join_csv(n_process, out_dir, debug, tile_size):
     header = ['pixel_' + str(j) for j in range(0, tile_size*tile_size)]
     header.extend(['orig_name', 'x', 'y', 'size', 'angle'])
     csv.writer(o).writerow(header)
+    o.close()
 
     # concatenate intermediate csv files into patches.csv
 
-    for i in range(0, n_process):
-        chunk_dir = out_dir + os.sep + '_chunk_dir' + str(i)
-        in_csv_name = chunk_dir + os.sep + 'patches' + str(i) + '.csv'
-        with open(in_csv_name) as n:
-            for line in n:
-                o.write(line)
-        if not debug:
-            shutil.rmtree(chunk_dir, ignore_errors=True)
+    in_csv_list = [out_dir + os.sep + '_chunk_dir' + str(i) + os.sep +\
+                    'patches' + str(i) + '.csv' for i in range(0, n_process)]
+    concat_files(n_process, in_csv_list, out_csv_name)
 
-    o.close()
+    if not debug:
+        for i in range(0, n_process):
+            chunk_dir = out_dir + os.sep + '_chunk_dir' + str(i)
+            shutil.rmtree(chunk_dir, ignore_errors=True)
 
 def main(argv):
 
@@ -469,6 +956,18 @@ def main(argv):
     in_dir = None
     out_dir = None
     debug = False
+    copy_files = False
+    output_format = 'csv'
+    stream = False
+    cache_dir = None
+    cache_size = 2048
+    incremental = False
+    patch_store = False
+    dedup = 'none'
+    backend = 'process'
+    contour_step = 1
+    contour_points = None
+    intensity_threshold = None
     tile_size = None
     downsample_size = 25
     stride_length = None
@@ -477,7 +976,7 @@ def main(argv):
     # parse command line args and update dependent args
 
     try:
-        opts, _ = getopt.getopt(argv, "p:i:o:g:t:d:s:v:h")
+        opts, _ = getopt.getopt(argv, "p:i:o:g:c:f:m:e:n:l:t:d:s:v:k:z:u:x:q:b:h")
         for opt, arg in opts:
             if opt == '-p':
                 n_process = int(arg)
@@ -487,6 +986,30 @@ def main(argv):
                 out_dir = arg
             elif opt == '-g':
                 debug = ast.literal_eval(arg)
+            elif opt == '-c':
+                copy_files = ast.literal_eval(arg)
+            elif opt == '-f':
+                output_format = arg.lower()
+            elif opt == '-m':
+                stream = ast.literal_eval(arg)
+            elif opt == '-k':
+                cache_dir = arg
+            elif opt == '-z':
+                cache_size = int(arg)
+            elif opt == '-u':
+                incremental = ast.literal_eval(arg)
+            elif opt == '-x':
+                patch_store = ast.literal_eval(arg)
+            elif opt == '-q':
+                dedup = arg.lower()
+            elif opt == '-b':
+                backend = arg.lower()
+            elif opt == '-e':
+                contour_step = int(arg)
+            elif opt == '-n':
+                contour_points = int(arg)
+            elif opt == '-l':
+                intensity_threshold = int(arg)
             elif opt == '-t':
                 tile_size = int(arg)
             elif opt == '-d':
@@ -511,6 +1034,32 @@ def main(argv):
         print 'Error: enter value for output directory (-o).'
         raise Exception
 
+    if output_format not in ['csv', 'npy']:
+        print 'Error: enter csv or npy for output format (-f).'
+        raise Exception
+
+    if patch_store and output_format != 'npy':
+        print 'Error: patch store (-x) requires npy output format (-f).'
+        raise Exception
+
+    if dedup not in ['none', 'image', 'global']:
+        print 'Error: enter none, image or global for dedup (-q).'
+        raise Exception
+
+    if dedup == 'global' and incremental:
+        print 'Error: global dedup (-q) cannot be combined with incremental'\
+              ' runs (-u).'
+        raise Exception
+
+    if backend not in ['process', 'thread', 'hybrid']:
+        print 'Error: enter process, thread or hybrid for backend (-b).'
+        raise Exception
+
+    if contour_step < 1 or (contour_points != None and contour_points < 1):
+        print 'Error: enter positive values for contour step (-e) and contour'\
+              ' points (-n).'
+        raise Exception
+
     if tile_size == None:
         print 'Error: enter value for tile_size (-t).'
         raise Exception
@@ -527,6 +1076,18 @@ def main(argv):
     print 'Input directory (i)      = %s' % (in_dir)
     print 'Output directory (-o)    = %s' % (out_dir)
     print 'Debug (-g)               = %s' % (debug)
+    print 'Copy files (-c)          = %s' % (copy_files)
+    print 'Output format (-f)       = %s' % (output_format)
+    print 'Stream (-m)              = %s' % (stream)
+    print 'Cache directory (-k)     = %s' % (cache_dir)
+    print 'Cache size (-z)          = %s' % (cache_size)
+    print 'Incremental (-u)         = %s' % (incremental)
+    print 'Patch store (-x)         = %s' % (patch_store)
+    print 'Dedup (-q)               = %s' % (dedup)
+    print 'Backend (-b)             = %s' % (backend)
+    print 'Contour step (-e)        = %s' % (contour_step)
+    print 'Contour points (-n)      = %s' % (contour_points)
+    print 'Intensity threshold (-l) = %s' % (intensity_threshold)
     print 'Tile size (-t)           = %s' % (tile_size)
     print 'Downsample size (-d)     = %s' % (downsample_size)
     print 'Stride length (-s)       = %s' % (stride_length)
@@ -536,79 +1097,182 @@ def main(argv):
 
     bigtic = time.time()
 
-    # init chunk directory structure and copy chunks of files
+    # conditionally find new or modified images, otherwise remove manifest of
+    # earlier incremental run
+
+    name_list = None
+    drop_set = None
+    if incremental:
+        parameters = {'tile_size': tile_size,\
+                      'downsample_size': downsample_size,\
+                      'stride_length': stride_length,\
+                      'variance_threshold': variance_threshold,\
+                      'output_format': output_format,\
+                      'contour_step': contour_step,\
+                      'contour_points': contour_points,\
+                      'intensity_threshold': intensity_threshold,\
+                      'dedup': dedup,\
+                      'patch_store': patch_store}
+        out_name_list = ['originals.csv', 'patches.csv']
+        if output_format == 'npy':
+            out_name_list = ['originals.npy', 'originals_meta.npy',\
+                             'originals.schema.json', 'patches.npy',\
+                             'patches_meta.npy', 'patches.schema.json']
+        name_list, drop_set, file_dict = find_changed_images(in_dir, out_dir,\
+            parameters, out_name_list)
+        if len(name_list) == 0 and drop_set != None and len(drop_set) == 0:
+            print 'No new, modified or removed images.'
+            return
+    elif os.path.exists(out_dir + os.sep + 'manifest.json'):
+        os.remove(out_dir + os.sep + 'manifest.json')
+
+    # init chunk directory structure and assign (or copy) chunks of files
 
     create_out_dirs(n_process, out_dir)
-    chunk_files(n_process, in_dir, out_dir)
+    chunk_list = chunk_files(n_process, in_dir, out_dir, copy_files,\
+                             name_list)
 
-    # multiprocessing map/reduce scheme to execute image manipulation tasks on
-    # chunks of image files in parallel
+    # init persistent cache of decoded greyscale images, or, for the process
+    # and hybrid backends, directory from which workers memory map decoded
+    # greyscale images
 
-    # convert original images to contours in a csv file using multiprocessing
-    # store in temporary files
+    grey_dir = cache_dir
+    if cache_dir == None and backend != 'thread':
+        grey_dir = out_dir + os.sep + '_grey_dir'
+    if grey_dir != None and not os.path.exists(grey_dir):
+        try:
+            os.makedirs(grey_dir)
+        except EnvironmentError as exception_:
+            print exception_
+            print 'Failed to create ' + grey_dir + '!'
+            sys.exit(-1)
 
-    print '-------------------------------------------------------------------'
-    print 'Converting original images to csv ... '
-    tic = time.time()
-    processes = []
-    try:
-        for i in range(0, int(n_process)):
-            process_name = 'Process_' + str(i)
-            process = Process(target=map_convert_originals, name=process_name,\
-            args=(i, out_dir))
-            process.start()
-            processes.append(process)
-        for process_ in processes:
-            process_.join()
-        print 'Images converted in %.2f s.' % (time.time()-tic)
-    except BaseException as exception_:
-        print exception_
-        print 'ERROR: Could not convert original images to csv.'
-        print sys.exc_info()
-        exit(-1)
+    # conditionally decode images to greyscale in threads first, so that the
+    # processes of later stages memory map decoded images
 
-    # reduce temporary contour csv files into a single large csv
+    if backend == 'hybrid':
+        print '-------------------------------------------------------------------'
+        print 'Decoding images ... '
+        tic = time.time()
+        work_queue = queue_files(n_process, chunk_list, 'thread')
+        try:
+            threads = start_workers(n_process, 'thread', map_decode,\
+                                    (work_queue, grey_dir))
+            join_workers(threads)
+            print 'Images decoded in %.2f s.' % (time.time()-tic)
+        except BaseException as exception_:
+            print exception_
+            print 'ERROR: Could not decode images.'
+            print sys.exc_info()
+            exit(-1)
 
-    print '-------------------------------------------------------------------'
-    print 'Combining original csv files ... '
-    reduce_join_original_csv(n_process, out_dir, debug)
-    print 'Done.'
-    print 'Csv files combined in %.2f s.' % (time.time()-tic)
+    # multiprocessing map/reduce scheme to execute image manipulation tasks on
+    # image files in parallel, each process taking files from a shared queue
 
-    # tile images using multiprocessing
-    # store in temporary files
+    # convert original images to contours and tile images using one set of
+    # workers, store in temporary files, or stream patches to final output
+    # file
 
     print '-------------------------------------------------------------------'
-    print 'Tiling images ... '
+    print 'Converting original images to ' + output_format +\
+        ' and tiling images ... '
     tic = time.time()
-    processes = []
+    work_queue = queue_files(n_process, chunk_list, backend)
+    out_queue = None
+    if stream:
+        out_queue = Queue()
+        if backend == 'thread':
+            out_queue = ThreadQueue()
+    size_ = tile_size
+    if downsample_size != None:
+        size_ = downsample_size
+    shared_dict = None
+    if dedup == 'global':
+        # a plain dict is shared by threads, as setdefault is atomic
+        shared_dict = {}
+        if backend != 'thread':
+            manager = multiprocessing.Manager()
+            shared_dict = manager.dict()
     try:
-        for i in range(0, int(n_process)):
-            process_name = 'Process_' + str(i)
-            process = Process(target=map_make_tiles, name=process_name,\
-            args=(i, out_dir, debug, tile_size, downsample_size,\
-                  stride_length, variance_threshold))
-            process.start()
-            processes.append(process)
-        for process_ in processes:
-            process_.join()
-        print 'Completed tiling images in %.2f s.' % (time.time()-tic)
+        processes = start_workers(n_process, backend, map_images,\
+            (work_queue, out_dir, debug, tile_size, downsample_size,\
+             stride_length, variance_threshold, output_format, contour_step,\
+             contour_points, intensity_threshold, out_queue, grey_dir, dedup,\
+             shared_dict))
+        if stream:
+            # keep chunk directories, which still hold contour files
+            reduce_stream(iter_batches(n_process, out_queue, processes),\
+                          out_dir, 'patches', True, size_, output_format,\
+                          ['orig_name', 'x', 'y', 'size', 'angle'])
+        join_workers(processes)
+        print 'Completed converting and tiling images in %.2f s.' %\
+            (time.time()-tic)
     except BaseException as exception_:
         print exception_
-        print 'ERROR: Could not tile images.'
+        print 'ERROR: Could not convert and tile images.'
         print sys.exc_info()
         exit(-1)
 
-    # reduce temporary files into a single large csv
+    # trim persistent cache only once all stages have read the decoded images
+
+    if cache_dir != None:
+        evict_greyscale_cache(cache_dir, cache_size, None)
+
+    # reduce temporary contour files into a single large csv (or npy)
 
     print '-------------------------------------------------------------------'
-    print 'Combining tile csv files ... '
-    size_ = tile_size
-    if downsample_size != None:
-        size_ = downsample_size
-    reduce_join_csv(n_process, out_dir, debug, size_)
+    print 'Combining original ' + output_format + ' files ... '
+    if output_format == 'npy':
+        reduce_join_original_npy(n_process, out_dir)
+    else:
+        reduce_join_original_csv(n_process, out_dir, debug)
     print 'Done.'
-    print 'Csv files combined in %.2f s.' % (time.time()-tic)
+    print 'Files combined in %.2f s.' % (time.time()-tic)
+
+    # reduce temporary files into a single large csv (or npy)
+
+    if stream and not debug:
+        for chunk_dir in glob.glob(out_dir + os.sep + '_chunk_dir*'):
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+
+    if not stream:
+        print '---------------------------------------------------------------'
+        print 'Combining tile ' + output_format + ' files ... '
+        if output_format == 'npy':
+            reduce_join_npy(n_process, out_dir, 'patches', debug, size_)
+        else:
+            reduce_join_csv(n_process, out_dir, debug, size_)
+        print 'Done.'
+        print 'Files combined in %.2f s.' % (time.time()-tic)
+
+    # conditionally merge output of earlier run and write manifest
+
+    if incremental:
+        if drop_set != None:
+            print '---------------------------------------------------------------'
+            print 'Merging output of earlier run ... '
+            if output_format == 'npy':
+                merge_previous_original_npy(out_dir, drop_set)
+                merge_previous_npy(out_dir, 'patches', drop_set, size_)
+            else:
+                merge_previous_csv(out_dir, 'originals.csv', drop_set, 3)
+                merge_previous_csv(out_dir, 'patches.csv', drop_set, -5)
+            shutil.rmtree(out_dir + os.sep + '_previous', ignore_errors=True)
+            print 'Done.'
+        save_manifest(out_dir, parameters, file_dict)
+
+    # conditionally sort rows into patch store
+
+    if patch_store:
+        tic = time.time()
+        print '---------------------------------------------------------------'
+        print 'Sorting patch store ... '
+        sort_npy(out_dir, 'patches', size_)
+        print 'Done.'
+        print 'Patch store sorted in %.2f s.' % (time.time()-tic)
+
+    if not debug:
+        shutil.rmtree(out_dir + os.sep + '_grey_dir', ignore_errors=True)
 
     print '-------------------------------------------------------------------'
     print 'All tasks completed in %.2f s.' % (time.time()-bigtic)
@@ -23,7 +23,7 @@ limitations under the License.
 Script using Python multiprocessing and PIL to complete independent image
 preprocessing tasks.
 
-Images are copied into n_process seperate folders and converted to greyscale.
+Images are split into n_process chunks and converted to greyscale.
 Original, full size images are coverted into x,y,z contours and written to csv.
 These countours serve as the background over which to lie interesting patches.
 Images are then tiled. Tiling can lead to the learning of translation-invariant
@@ -51,15 +51,51 @@ n_process: (-p) Number of processes to use; the script will create this many
 in_dir: (-i) Directory in which input images are located. This directory should
         contain only image files of type JPG, PNG, BMP or TIFF. The files must
         also have standard file extensions to be recognized by the script.
-        Files will be copied into their respective chunk directories before
-        being tiled, (and/or downsampled,) flattened, and converted to csv.
+        Files are read directly from in_dir by each process and are only
+        copied into their respective chunk directories when -c is set.
 
 out_dir: (-o) Parent directory in which the sub-directories for each chunk of
          image files will be created. A large number temporary files will be
-         created in out_dir.
+         created in out_dir. Each image is decoded to greyscale only once, in
+         the contour stage, and saved to out_dir/_grey_dir (or cache_dir),
+         from which the tiling stage memory maps it.
 
 debug: (-g) Leaves temporary files in out_dir. (default=False)
 
+copy_files: (-c) Copies image files into their respective chunk directories
+            before they are processed, rather than reading them directly from
+            in_dir. (default=False)
+
+output_format: (-f) Format of the final output, csv or npy. The npy format
+               writes the uint8 pixel intensities of each patch as a row of
+               patches.npy, the orig_name, x, y, size and angle of each patch
+               as a row of patches_meta.npy, and a description of both files
+               to patches.schema.json. Original image contours are likewise
+               written as x, y, z rows of the int32 matrix originals.npy, with
+               the orig_name, width, height, contour step, number of points
+               and first row of each image in originals_meta.npy and a
+               description in originals.schema.json.
+               All .npy files can be loaded (or memory mapped) with numpy.load
+               without parsing. (default=csv)
+
+stream: (-m) Streams batches of flattened patches from each process to a
+        single writer, which writes them directly into the final output
+        file. No intermediate patches files are written. (default=False)
+
+contour_step: (-e) Only every contour_step-th pixel in each direction of the
+              original images is written to originals.csv, reducing the size
+              of originals.csv, and the memory needed to plot it, by a factor
+              of about contour_step*contour_step. x and y values remain in
+              original pixel coordinates. (default=1)
+
+contour_points: (-n) Approximate maximum number of contour points written to
+                originals.csv for each original image. If set, contour_step is
+                increased for each image as needed. (default=None)
+
+intensity_threshold: (-l) Pixels with a greyscale intensity below this value,
+                     i.e. with a z value above 255 - intensity_threshold, are
+                     not written to originals.csv. (default=None)
+
 downsample_size: (-d) Side length of downsampled square image patches measured
                  in pixels. By default image patches are downsampled before
                  being flattened, resulting in each row vector of patches.csv
@@ -76,6 +112,47 @@ angle: (-a) Patches will be rotated this angle in degrees before being
        positive and negative directions to prevent creating many copies of each
        patch. (default=10)
 
+pyramid: (-y) Builds an image pyramid of each original image, halving its
+         size at each level, and cuts each kept patch from the smallest level
+         at which the patch is still at least downsample_size pixels wide.
+         Patches are then resampled from a small crop instead of from the full
+         resolution patch, which is much faster for large images. Patches are
+         selected exactly as without -y, but their pixel intensities differ
+         slightly. (default=False)
+
+cache_dir: (-k) Directory in which decoded greyscale images are kept across
+           runs, as memory-mappable .npy files keyed by the MD5 hash of each
+           image file. Runs over the same input images with different
+           settings then skip decoding. (default=None)
+
+cache_size: (-z) Size limit of cache_dir measured in megabytes. At the end
+            of each run, once all stages have read the decoded images, the
+            least recently used images are removed from cache_dir while it
+            is larger than cache_size. (default=2048)
+
+incremental: (-u) Processes only the images that were added to or modified in
+             in_dir since the last incremental run with the same options, and
+             merges their rows into the existing output files, dropping the
+             rows of modified or removed images. Processed images and options
+             are recorded in out_dir/manifest.json. (default=False)
+
+patch_store: (-x) Sorts the rows of patches.npy and patches_meta.npy by
+             orig_name, x, y, size and angle, so that the output directory
+             can be opened as a memory-mapped patch store with
+             patch_store.py. The patches of an image, or of a region of an
+             image, are then found by binary search and sliced without
+             copying. Requires npy output format (-f). (default=False)
+
+dedup: (-q) Drops patches whose average hash, a compact perceptual hash of
+       the (downsampled) patch, equals that of a patch kept earlier: none,
+       image or global. With image, duplicates are dropped within each
+       image. With global, all workers share one set of hashes, so
+       duplicates are dropped across images; which copy is kept then depends
+       on the order in which workers reach them. Global cannot be combined
+       with incremental runs (-u), which would drop duplicates only among
+       the new or modified images. The number of dropped patches of each
+       image is printed. (default=none)
+
 Run threaded_tile_r.py from an IDE by setting constants in main OR by the
 command line. Example command line usage:
 
@@ -94,8 +171,14 @@ import os
 import shutil
 import sys
 import time
-from multiprocessing import Process
+from multiprocessing import Process, Queue
 from PIL import Image
+from threaded_common import concat_files, contour_csv_lines,\
+    evict_greyscale_cache, find_changed_images, image_names, is_duplicate,\
+    iter_batches, merge_previous_csv, merge_previous_npy,\
+    merge_previous_original_npy, open_greyscale, queue_files, reduce_join_npy,\
+    reduce_join_original_npy, reduce_stream, save_chunk_meta, save_manifest,\
+    sort_npy
 
 def create_out_dirs(n_process, out_dir):
 
@@ -130,16 +213,25 @@ def create_out_dirs(n_process, out_dir):
 
     print 'Done.'
 
-def chunk_files(n_process, in_dir, out_dir):
+def chunk_files(n_process, in_dir, out_dir, copy_files=False, name_list=None):
 
-    """ Separates the image in in_dir into n_process roughly equal chunks of
-    files, each in a separate directory created by create_out_dirs.
+    """ Separates the images in in_dir into n_process roughly equal chunks of
+    files. By default no files are copied; each chunk is a list of paths into
+    in_dir that the processes read directly. If copy_files is set, the
+    images are also copied into the separate directories created by
+    create_out_dirs and the chunks refer to the copies.
 
     Args:
         n_process: Number of processes specified by the user.
         in_dir: Directory in which original image files are located.
         out_dir: Directory in which to create intermediate files and final
                  patches.csv file.
+        copy_files: If true, copies image files into chunk directories.
+        name_list: Names of the image files in in_dir to chunk. By default,
+                   all image files in in_dir are chunked.
+
+    Returns:
+        List of n_process lists of image file paths.
 
     Raises:
         EnvironemtError: Problem copying image files.
@@ -151,16 +243,23 @@ def chunk_files(n_process, in_dir, out_dir):
     # local constants
 
     check_point_value = 1000
-    image_type_list = ['JPG', 'JPEG', 'PNG', 'BMP', 'TIFF']
 
-     # copy files
+    # assign files to chunks, conditionally copy files
 
-    file_list = [name for name in os.listdir(in_dir)\
-                    if name.split('.')[-1].upper() in image_type_list]
+    file_list = name_list
+    if file_list == None:
+        file_list = image_names(in_dir)
+
+    chunk_list = [[] for _ in range(0, int(n_process))]
 
     for i, name in enumerate(file_list):
 
         source_file = in_dir + os.sep + name
+
+        if not copy_files:
+            chunk_list[i % n_process].append(source_file)
+            continue
+
         chunk_outdir = out_dir + os.sep + '_chunk_dir' +\
             str(int(i % n_process))
         chunk_file = chunk_outdir + os.sep + name
@@ -175,20 +274,39 @@ def chunk_files(n_process, in_dir, out_dir):
             print 'Failed to copy' + name + '!'
             sys.exit(-1)
 
+        chunk_list[i % n_process].append(chunk_file)
+
         if i % check_point_value == 0 and i != 0:
             print 'Processing file %i ...' % (i)
 
     print 'Done.'
 
-def map_convert_originals(i, out_dir):
+    return chunk_list
+
+def map_convert_originals(i, work_queue, out_dir, output_format='csv',
+                          contour_step=1, contour_points=None,
+                          intensity_threshold=None, grey_dir=None):
 
     """ Write original image file to csv as x,y,z contours. These countours are
-    used as the background over which to lie interesting patches.
+    used as the background over which to lie interesting patches. Contours are
+    formatted in bands of rows, each with a single vectorized call. If
+    output_format is 'npy', contours are instead written to an intermediate
+    binary file of int32 x,y,z rows with a separate metadata array. Contours
+    can be written at reduced resolution, on a grid of every contour_step-th
+    pixel, and pixels below an intensity threshold can be skipped.
 
     Args:
         i: Process index.
+        work_queue: Queue of image file paths shared by all processes.
         out_dir: Directory in which to create intermediate files and final
                  originals.csv file.
+        output_format: Format of intermediate files, 'csv' or 'npy'.
+        contour_step: Distance in pixels between contour points in each
+                      direction.
+        contour_points: Approximate maximum number of contour points for each
+                        image. If set, contour_step is increased as needed.
+        intensity_threshold: Pixel intensity below which pixels are skipped.
+        grey_dir: Directory of decoded greyscale images shared by all stages.
 
     Raises:
         EnvironemtError: Problem creating csv file.
@@ -198,47 +316,78 @@ def map_convert_originals(i, out_dir):
 
     process_name = multiprocessing.current_process().name
     chunk_dir = out_dir + os.sep + '_chunk_dir' + str(i)
-    image_type_list = ['JPG', 'JPEG', 'PNG', 'BMP', 'TIFF']
-
-    # cycle through original images in chunk_dir and convert to csv using
-    # pandas
+    band_pixels = 2**20
+    meta_list = []
 
-    file_list = [name for name in os.listdir(chunk_dir)\
-                    if name.split('.')[-1].upper() in image_type_list]
+    # cycle through original images in work_queue and convert to csv
 
-    for name in file_list:
+    for chunk_file in iter(work_queue.get, None):
 
-        print process_name + ': Converting ' + name + ' to csv ...'
-        chunk_file = chunk_dir + os.sep + name
+        name = os.path.basename(chunk_file)
+        print process_name + ': Converting ' + name + ' to ' + output_format +\
+            ' ...'
 
         out_csv_name = chunk_dir + os.sep + 'orig.' + name + '.csv'
+        if output_format == 'npy':
+            out_csv_name = chunk_dir + os.sep + 'orig.' + name + '.bin'
         try:
             if os.path.exists(out_csv_name):
-                os.remove(out_csv_name, ignore_errors=True)
+                os.remove(out_csv_name)
             o = open(out_csv_name, 'wb')
         except EnvironmentError as exception_:
             print exception_
             print 'Failed to create ' + out_csv_name + '!'
             sys.exit(-1)
 
-        im = Image.open(chunk_file).convert('L')
-        w, h = im.size
-        x = np.tile(np.arange(w), h).T + 1
-        y = np.repeat(np.arange(h-1, -1, -1), w).T + 1
-        z = 255-np.asarray(im.getdata()).T
+        _, im_array = open_greyscale(chunk_file, grey_dir)
+        h, w = im_array.shape
 
-        wr = csv.writer(o)
-        for i in range(0, w*h):
-            wr.writerow([x[i], y[i], z[i], name])
+        # conditionally increase step to meet contour_points
+
+        step = contour_step
+        if contour_points != None:
+            step = max(step, int(np.ceil(np.sqrt(float(w*h)/contour_points))))
+        grid = im_array[::step, ::step]
+        grid_x = np.arange(0, w, step) + 1
+        band_rows = max(1, band_pixels/len(grid_x))
+        n_points = 0
+
+        # write contours of each band of grid rows, top row has y = h
+
+        for top in range(0, len(grid), band_rows):
+
+            band = grid[top:top + band_rows]
+            x = np.tile(grid_x, len(band))
+            y = np.repeat(h - (top + np.arange(len(band)))*step, len(grid_x))
+            z = 255 - band.ravel().astype(np.int32)
+
+            # conditionally skip dark pixels
+            if intensity_threshold != None:
+                keep = band.ravel() >= intensity_threshold
+                x, y, z = x[keep], y[keep], z[keep]
+                if len(x) == 0:
+                    continue
+            n_points += len(x)
+
+            if output_format == 'npy':
+                o.write(np.column_stack((x, y, z)).astype('<i4').tobytes())
+            else:
+                o.write(contour_csv_lines(x, y, z, name))
 
         o.close()
+        meta_list.append((name, w, h, step, n_points))
+
+    if output_format == 'npy':
+        save_chunk_meta(chunk_dir + os.sep + 'orig' + str(i) + '_meta.npy',\
+                        meta_list, ['orig_name', 'width', 'height', 'step',\
+                                    'points'])
 
     print process_name + ': Done.'
 
 def reduce_join_original_csv(n_process, out_dir):
 
     """ Creates out_dir/originals.csv, writes csv header to originals.csv, and
-    concatenates intermediate csv files into orginals.csv.
+    concatenates intermediate csv files in parallel into orginals.csv.
 
     Args:
         n_process: Number of processes specified by the user.
@@ -267,9 +416,11 @@ def reduce_join_original_csv(n_process, out_dir):
     header = ['x', 'y', 'z', 'orig_name']
 
     csv.writer(o).writerow(header)
+    o.close()
 
     # concatenate intermediate csv files into originals.csv
 
+    in_csv_list = []
     for i in range(0, n_process):
 
         chunk_dir = out_dir + os.sep + '_chunk_dir' + str(i)
@@ -278,27 +429,363 @@ def reduce_join_original_csv(n_process, out_dir):
                     if name.split('.')[0].upper() == 'ORIG']
 
         for name in file_list:
+            in_csv_list.append(chunk_dir + os.sep + name)
 
-            in_csv_name = chunk_dir + os.sep + name
-            with open(in_csv_name) as n:
-                for line in n:
-                    o.write(line)
+    concat_files(n_process, in_csv_list, out_csv_name)
 
-    o.close()
+def summed_area_tables(im_array, rows=None, cols=None):
+
+    """ Creates summed-area tables of pixel intensities and squared pixel
+    intensities. Element [i, j] of each table holds the sum over all pixels
+    above row rows[i] and to the left of column cols[j], so the sum over any
+    rectangle with bounds in rows and cols can be read from four elements.
+    Tables restricted to the bounds of a few patches are built from block
+    sums in one pass over the image per table, and are much smaller than the
+    image.
+
+    Args:
+        im_array: Greyscale image as 2-D numpy array.
+        rows: Sorted array of distinct y values, starting at 0, at which
+              patch bounds lie. (default=every row)
+        cols: Sorted array of distinct x values, starting at 0, at which
+              patch bounds lie. (default=every column)
+
+    Returns:
+        Tuple of summed-area tables of pixel intensities and squared pixel
+        intensities, each of shape (len(rows), len(cols)).
+    """
+
+    # local constants
+
+    squares = (np.arange(256)**2).astype(np.uint16)
+
+    h, w = im_array.shape
+    if rows is None:
+        rows = np.arange(h + 1)
+    if cols is None:
+        cols = np.arange(w + 1)
+
+    table_list = []
+    for values in [im_array, squares[im_array]]:
+
+        # sum blocks between consecutive bounds, then accumulate blocks
+        blocks = np.add.reduceat(values, rows[rows < h], axis=0,\
+                                 dtype=np.int64)
+        blocks = np.add.reduceat(blocks, cols[cols < w], axis=1)
+        table = np.zeros((len(rows), len(cols)), dtype=np.int64)
+        table[1:, 1:] = blocks.cumsum(axis=0).cumsum(axis=1)\
+                            [:len(rows) - 1, :len(cols) - 1]
+        table_list.append(table)
+
+    return tuple(table_list)
+
+def patch_std(sat, sat_sq, left, upper, right, lower, rows=None, cols=None):
+
+    """ Calculates the standard deviation of pixel intensities of rectangular
+    patches in constant time per patch from summed-area tables. Patch bounds
+    follow the same convention as the PIL crop box and may be scalars or numpy
+    arrays.
+
+    Args:
+        sat: Summed-area table of pixel intensities.
+        sat_sq: Summed-area table of squared pixel intensities.
+        left: Left x value(s) of the patch(es).
+        upper: Upper y value(s) of the patch(es).
+        right: Right x value(s) of the patch(es), exclusive.
+        lower: Lower y value(s) of the patch(es), exclusive.
+        rows: The rows argument of summed_area_tables, if the tables are
+              restricted to patch bounds. (default=every row)
+        cols: The cols argument of summed_area_tables, if the tables are
+              restricted to patch bounds. (default=every column)
+
+    Returns:
+        Standard deviation(s) of pixel intensities of the patch(es).
+    """
+
+    # find table elements of patch bounds
+    i_upper, i_lower, j_left, j_right = upper, lower, left, right
+    if rows is not None:
+        i_upper, i_lower = np.searchsorted(rows, [upper, lower])
+    if cols is not None:
+        j_left, j_right = np.searchsorted(cols, [left, right])
+
+    def rect_sum(table):
+        return (table[i_lower, j_right] - table[i_upper, j_right] -\
+                table[i_lower, j_left] + table[i_upper, j_left])\
+                .astype(np.float64)
+
+    n = np.asarray((right - left) * (lower - upper), dtype=np.float64)
+    total, total_sq = rect_sum(sat), rect_sum(sat_sq)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = (n * total_sq - total * total) / (n * n)
+
+    return np.sqrt(np.maximum(var, 0))
+
+def build_pyramid(im, min_size):
+
+    """ Builds an image pyramid by repeatedly halving the size of an image with
+    an antialiasing filter.
+
+    Args:
+        im: PIL image.
+        min_size: Levels are added while the short side of the last level is
+                  at least twice min_size.
+
+    Returns:
+        List of PIL images, starting with im at full resolution.
+    """
+
+    pyramid = [im]
+    while min(pyramid[-1].size) >= 2*min_size:
+        w, h = pyramid[-1].size
+        pyramid.append(pyramid[-1].resize((w/2, h/2), Image.ANTIALIAS))
+
+    return pyramid
+
+def pyramid_crop(pyramid, box, downsample_size):
+
+    """ Crops a patch from the smallest pyramid level at which it is at least
+    downsample_size pixels wide and resamples it to downsample_size.
+
+    Args:
+        pyramid: List of PIL images from build_pyramid.
+        box: Crop box of the patch at full resolution, as for PIL crop.
+        downsample_size: Side length of downsampled square image patches
+                         measured in pixels.
+
+    Returns:
+        The downsampled patch as PIL image.
+    """
+
+    left, upper, right, lower = box
+    w, h = pyramid[0].size
+
+    # find smallest level, at most halving the patch size per level
+    level = 0
+    size_ = min(right - left, lower - upper)
+    while level + 1 < len(pyramid) and size_/2 >= downsample_size:
+        level += 1
+        size_ /= 2
+
+    # scale crop box to level
+    scale_x = pyramid[level].size[0]/float(w)
+    scale_y = pyramid[level].size[1]/float(h)
+    tile = pyramid[level].crop((int(round(left*scale_x)),\
+                                int(round(upper*scale_y)),\
+                                int(round(right*scale_x)),\
+                                int(round(lower*scale_y))))
+
+    if tile.size != (downsample_size, downsample_size):
+        tile = tile.resize((downsample_size, downsample_size), Image.ANTIALIAS)
+
+    return tile
+
+def make_random_tiles(im_array, downsample_size, variance_threshold, angle,
+                      pyramid=False):
+
+    """ Creates differently sized patches from an image, conditionally
+    creates rotated copies of the patches, tests patches for sufficient pixel
+    intensity variance and conditionally down- or up- samples the patches.
+    Patch sizes are drawn from a random number generator seeded identically
+    for each image.
+
+    Args:
+        im_array: Greyscale image as 2-D numpy array.
+        downsample_size: Side length of downsampled square image patches
+                         measured in pixels. If set, image patches are
+                         downsampled.
+        variance_threshold: The standard deviation above which a patch will be
+                            kept. If None, derived from the image size.
+        angle: patches will be rotated this angle in degrees.
+        pyramid: If true and downsample_size is set, kept patches are cut from
+                 an image pyramid before being downsampled.
+
+    Yields:
+        Tuples of upper-lefthand x and y values, size, angle and the 2-D
+        uint8 numpy array of each patch.
+    """
+
+    # local constants
+
+    tiles_per_short_side = 20
+
+    im = Image.fromarray(im_array)
+    w, h = im.size
+    short_side_length = min(w, h)
+
+    # conditionally rotate the image once in each direction
+    rotated = {0: im}
+    if angle != None and angle != 0:
+        rotated[angle] = im.rotate(angle)
+        rotated[-angle] = im.rotate(-angle)
+
+    # conditionally build image pyramids of the image and rotated images
+    pyramids = None
+    if pyramid and downsample_size != None:
+        pyramids = {}
+        for angle_, im_ in rotated.items():
+            pyramids[angle_] = build_pyramid(im_, downsample_size)
+
+    # check variance_threshold
+    if variance_threshold == None:
+        variance_threshold = short_side_length/60
+
+    # init stride_length based on image size
+    stride_length = int(short_side_length/tiles_per_short_side)
+
+    # init tile_counter
+    tile_counter = 0
+
+    # init size_
+    np.random.seed(1234)
+    size_ = np.random.randint(short_side_length)
+
+    # find bounds and orientation of patches ###############################
+
+    box_list = []
+    reached_y_edge = False
+    for y in range(0, h, stride_length):
+
+        y_ = y
+        if reached_y_edge:
+            continue
+        else:
+            my = min(y + size_, h)
+            if my == h:
+                y_ = h - size_
+                reached_y_edge = True
+
+        reached_x_edge = False
+        for x in range(0, w, stride_length):
+
+            x_ = x
+            if reached_x_edge:
+                continue
+            else:
+                mx = min(x + size_, w)
+                if mx == w:
+                    x_ = w - size_
+                    reached_x_edge = True
+
+            # conditionally rotate every other image
+            angle_ = 0
+            if angle != None and angle != 0:
+                if x > 0 and not reached_x_edge:
+                    if y > 0 and not reached_x_edge:
+                        if tile_counter % 2 == 0:
+                            if tile_counter % 4 == 0:
+                                angle_ = angle
+                            else:
+                                angle_ = -angle
+
+            box_list.append((x_, y_, mx, my, size_, angle_))
+
+            # init next iter
+            tile_counter +=1
+            size_ = np.random.randint(short_side_length)
+
+    # check image variance of all patches of each orientation at once, from
+    # summed-area tables of the unrotated or rotated image restricted to
+    # the bounds of its patches
+
+    boxes = np.array(box_list, dtype=np.int64).reshape(-1, 6)
+    std = np.zeros(len(boxes))
+    for angle_, im_ in rotated.items():
+        index = np.nonzero(boxes[:, 5] == angle_)[0]
+        if len(index) == 0:
+            continue
+        left, upper, right, lower = boxes[index, :4].T
+        rows = np.unique(np.concatenate([[0], upper, lower]))
+        cols = np.unique(np.concatenate([[0], left, right]))
+        sat, sat_sq = summed_area_tables(np.asarray(im_), rows, cols)
+        std[index] = patch_std(sat, sat_sq, left, upper, right, lower, rows,\
+                               cols)
+
+    # create patches #######################################################
+
+    for (x_, y_, mx, my, size_, angle_), std_ in zip(box_list, std):
+
+        if std_ > variance_threshold:
+
+            # conditionally cut downsampled patches from pyramid
+            if pyramids != None:
+                tile = pyramid_crop(pyramids[angle_], (x_, y_, mx, my),\
+                                    downsample_size)
+            else:
+
+                # crop patches from the unrotated or rotated image
+                # only once they are kept
+                tile = rotated[angle_].crop((x_, y_, mx, my))
+
+                # conditionally downsample patches
+                if downsample_size != None:
+                    tile = tile.resize((downsample_size, downsample_size),\
+                                       Image.ANTIALIAS)
+            yield x_, y_, size_, angle_, np.asarray(tile)
+
+def iter_random_patches(images, downsample_size=25, variance_threshold=None,
+                        angle=10, pyramid=False, batch_size=256):
+
+    """ Lazily creates differently sized, conditionally rotated patches from
+    images in the calling process, for use from other Python code without
+    writing any files. Defaults are the same as for the command line.
+
+    Args:
+        images: Iterable of image file paths, or of tuples of an image name
+                and a PIL image or 2-D numpy array.
+        downsample_size: Side length of downsampled square image patches
+                         measured in pixels. Must be set when batches are
+                         yielded, as patches otherwise differ in size.
+        variance_threshold: The standard deviation above which a patch will be
+                            kept. (default=short side length of image/60)
+        angle: patches will be rotated this angle in degrees.
+        pyramid: If true, kept patches are cut from an image pyramid before
+                 being downsampled.
+        batch_size: Maximum number of patches in each batch.
+
+    Yields:
+        Tuples of a uint8 pixel matrix, with one flattened patch per row, and
+        a list of (orig_name, x, y, size, angle) metadata tuples, one per row.
+    """
+
+    pixel_list, meta_list = [], []
+
+    for image in images:
+
+        name, im_array = open_greyscale(image)
+
+        for x_, y_, size_, angle_, tile in make_random_tiles(im_array,\
+                downsample_size, variance_threshold, angle, pyramid):
+
+            pixel_list.append(tile.flatten())
+            meta_list.append((name, x_, y_, size_, angle_))
 
-def map_make_tiles(i, out_dir, debug, downsample_size, variance_threshold,
-                   angle):
+            if len(meta_list) == batch_size:
+                yield np.vstack(pixel_list), meta_list
+                pixel_list, meta_list = [], []
+
+    if len(meta_list) > 0:
+        yield np.vstack(pixel_list), meta_list
+
+def map_make_tiles(i, work_queue, out_dir, debug, downsample_size,
+                   variance_threshold, angle, output_format='csv',
+                   out_queue=None, pyramid=False, grey_dir=None,
+                   dedup='none', shared_dict=None):
 
     """ In each process: by default creates differently sized patches,
     conditionally creates rotated copies of the patches, tests patches for
     sufficient pixel intensity variance, down-or up-samples the
     patches, flattens patches into row vector of pixel intensities, and saves
-    row vector to intermediate csv. Variance threshold and rotation angle
-    defaults can be overridden by setting constants in main or by command line
-    options.
+    row vector to intermediate csv, or, if output_format is 'npy', to an
+    intermediate binary file of uint8 pixels with a separate metadata array.
+    If out_queue is set, no intermediate files are written; batches of row
+    vectors are put on out_queue instead, followed by None. Variance threshold
+    and rotation angle defaults can be overridden by setting constants in main
+    or by command line options.
 
     Args:
         i: Process index.
+        work_queue: Queue of image file paths shared by all processes.
         out_dir: Directory in which to create intermediate files and final
                  patches.csv file.
         debug: If true, preserves intermediate image patches.
@@ -309,6 +796,16 @@ def map_make_tiles(i, out_dir, debug, downsample_size, variance_threshold,
                             flattened and saved to patches.csv.
         angle: patches will be rotated this angle in degrees before being
                flattened and added to patches.csv.
+        output_format: Format of intermediate files, 'csv' or 'npy'.
+        out_queue: Queue on which to put batches of flattened patches, as
+                   tuples of a uint8 pixel matrix and a list of metadata.
+        pyramid: If true, kept patches are cut from an image pyramid before
+                 being downsampled.
+        grey_dir: Directory of decoded greyscale images shared by all stages.
+        dedup: Drops patches with the same average hash as a patch kept
+               earlier: 'none', 'image' or 'global'.
+        shared_dict: Dict of the hashes seen by all processes, if dedup is
+                     'global'.
 
     Raises:
         EnvironemtError: Problem creating csv file.
@@ -317,126 +814,96 @@ def map_make_tiles(i, out_dir, debug, downsample_size, variance_threshold,
     # local constants
 
     process_name = multiprocessing.current_process().name
+    seen_set = set()
     chunk_dir = out_dir + os.sep + '_chunk_dir' + str(i)
-    image_type_list = ['JPG', 'JPEG', 'PNG', 'BMP', 'TIFF']
-    tiles_per_short_side = 20
+    batch_size = 256
+    meta_list = []
+    pixel_list = []
 
-    # open intermediate csv for writing flattened images
+    # open intermediate csv (or binary file) for writing flattened images
 
     out_csv_name = chunk_dir + os.sep + 'patches' + str(i) + '.csv'
+    if output_format == 'npy':
+        out_csv_name = chunk_dir + os.sep + 'patches' + str(i) + '.bin'
     try:
-        if os.path.exists(out_csv_name):
-            shutil.rmtree(out_csv_name, ignore_errors=True)
-        o = open(out_csv_name, 'wb')
-        wr = csv.writer(o)
+        if out_queue is None:
+            if os.path.exists(out_csv_name):
+                shutil.rmtree(out_csv_name, ignore_errors=True)
+            o = open(out_csv_name, 'wb')
+            wr = csv.writer(o)
     except EnvironmentError as exception_:
         print exception_
         print 'Failed to create ' + out_csv_name + '!'
         sys.exit(-1)
 
-    file_list = [name for name in os.listdir(chunk_dir)\
-                    if name.split('.')[-1].upper() in image_type_list]
-
-    for name in file_list:
+    for chunk_file in iter(work_queue.get, None):
 
+        name, im_array = open_greyscale(chunk_file, grey_dir)
         print process_name + ': tiling ' + name + ' ...'
-
-        chunk_file = chunk_dir + os.sep + name
-        im = Image.open(chunk_file).convert('L')
-        w, h = im.size
-        short_side_length = min(w, h)
-
-        # check variance_threshold
-        if variance_threshold == None:
-            variance_threshold = short_side_length/60
-
-        # init stride_length based on image size
-        stride_length = int(short_side_length/tiles_per_short_side)
-
-        # init tile_counter
-        tile_counter = 0
-
-        # init size_
-        np.random.seed(1234)
-        size_ = np.random.randint(short_side_length)
+        if dedup == 'image':
+            seen_set = set()
+        n_duplicate = 0
 
         # create patches from each file #######################################
 
-        reached_y_edge = False
-        for y in range(0, h, stride_length):
+        for x_, y_, size_, angle_, tile in make_random_tiles(im_array,\
+                downsample_size, variance_threshold, angle, pyramid):
 
-            y_ = y
-            if reached_y_edge:
+            # conditionally drop nearly identical patches
+            if dedup != 'none' and\
+                    is_duplicate(tile, seen_set, shared_dict, i):
+                n_duplicate += 1
                 continue
+
+            if debug:
+                tile_fname = os.path.join(chunk_dir,\
+                    'patch.%s.%d.%d.%d.%d.png' %\
+                    (name, x_, y_, size_, angle_))
+                Image.fromarray(tile).save(tile_fname, "PNG")
+
+            # put batches of pixels and metadata on out_queue
+            if out_queue is not None:
+                pixel_list.append(tile.flatten())
+                meta_list.append((name, x_, y_, size_, angle_))
+                if len(meta_list) == batch_size:
+                    out_queue.put((np.vstack(pixel_list), meta_list))
+                    pixel_list, meta_list = [], []
+
+            # save pixels and metadata to intermediate binary files
+            elif output_format == 'npy':
+                o.write(tile.tobytes())
+                meta_list.append((name, x_, y_, size_, angle_))
+
+            # flatten patches into row vector of pixel intensities
+            # and save row vector to intermediate csv
             else:
-                my = min(y + size_, h)
-                if my == h:
-                    y_ = h - size_
-                    reached_y_edge = True
+                tile_list = tile.flatten().tolist()
+                tile_list.extend([name, x_, y_, size_, angle_])
+                wr.writerow(tile_list)
 
-            reached_x_edge = False
-            for x in range(0, w, stride_length):
+        if dedup != 'none':
+            print process_name + ': dropped %d duplicate patches of %s.' %\
+                (n_duplicate, name)
 
-                x_ = x
-                if reached_x_edge:
-                    continue
-                else:
-                    mx = min(x + size_, w)
-                    if mx == w:
-                        x_ = w - size_
-                        reached_x_edge = True
-
-                tile = im.crop((x_, y_, mx, my))
-
-                # conditionally rotate every other image
-                # and over write patch
-                angle_ = 0
-                if angle != None and angle != 0:
-                    im_rplus = im.rotate(angle)
-                    im_rminus = im.rotate(-angle)
-                    if x > 0 and not reached_x_edge:
-                        if y > 0 and not reached_x_edge:
-                            if tile_counter % 2 == 0:
-                                if tile_counter % 4 == 0:
-                                    angle_ = angle
-                                    tile = im_rplus.crop((x_, y_, mx, my))
-                                else:
-                                    angle_ = -angle
-                                    tile = im_rminus.crop((x_, y_, mx, my))
-
-                # check image variance
-                std = np.std(np.array(tile))
-                if std > variance_threshold:
-
-                    # conditionally downsample patches
-                    if downsample_size != None:
-                        tile = tile.resize((downsample_size, downsample_size),\
-                                            Image.ANTIALIAS)
-
-                    if debug:
-                        tile_fname = os.path.join(chunk_dir,\
-                            'patch.%s.%d.%d.%d.%d.png' %\
-                            (name, x_, y_, size_, angle_))
-                        tile.save(tile_fname, "PNG")
-
-                    # flatten patches into row vector of pixel intensities
-                    tile_list = list(tile.getdata())
-                    tile_list.extend([name, x_, y_, size_, angle_])
-
-                    # save row vector to intermediate csv
-                    wr.writerow(tile_list)
-
-                # init next iter
-                tile_counter +=1
-                size_ = np.random.randint(short_side_length)
+    if out_queue is not None:
+        if len(meta_list) > 0:
+            out_queue.put((np.vstack(pixel_list), meta_list))
+        out_queue.put(None)
+        print process_name + ': Done.'
+        return
 
     o.close()
+
+    if output_format == 'npy':
+        save_chunk_meta(chunk_dir + os.sep + 'patches' + str(i) + '_meta.npy',\
+                        meta_list, ['orig_name', 'x', 'y', 'size', 'angle'])
+
     print process_name + ': Done.'
 
 def reduce_join_tile_csv(n_process, out_dir, debug, tile_size):
 
     """ Creates out_dir/patches.csv, writes csv header to patches.csv, and
-    concatenates intermediate csv files into patches.csv.
+    concatenates intermediate csv files in parallel into patches.csv.
 
     Args:
         n_process: Number of processes specified by the user.
@@ -467,19 +934,18 @@ def reduce_join_tile_csv(n_process, out_dir, debug, tile_size):
     header = ['pixel_' + str(j) for j in range(0, tile_size*tile_size)]
     header.extend(['orig_name', 'x', 'y', 'size', 'angle'])
     csv.writer(o).writerow(header)
+    o.close()
 
     # concatenate intermediate csv files into patches.csv
 
-    for i in range(0, n_process):
-        chunk_dir = out_dir + os.sep + '_chunk_dir' + str(i)
-        in_csv_name = chunk_dir + os.sep + 'patches' + str(i) + '.csv'
-        with open(in_csv_name) as n:
-            for line in n:
-                o.write(line)
-        if not debug:
-            shutil.rmtree(chunk_dir, ignore_errors=True)
+    in_csv_list = [out_dir + os.sep + '_chunk_dir' + str(i) + os.sep +\
+                    'patches' + str(i) + '.csv' for i in range(0, n_process)]
+    concat_files(n_process, in_csv_list, out_csv_name)
 
-    o.close()
+    if not debug:
+        for i in range(0, n_process):
+            chunk_dir = out_dir + os.sep + '_chunk_dir' + str(i)
+            shutil.rmtree(chunk_dir, ignore_errors=True)
 
 def main(argv):
 
@@ -498,14 +964,26 @@ def main(argv):
     in_dir = None
     out_dir = None
     debug = False
+    copy_files = False
+    output_format = 'csv'
+    stream = False
+    cache_dir = None
+    cache_size = 2048
+    incremental = False
+    patch_store = False
+    dedup = 'none'
+    contour_step = 1
+    contour_points = None
+    intensity_threshold = None
     downsample_size = 25
     variance_threshold = None
     angle = 10
+    pyramid = False
 
     # parse command line args and update dependent args
 
     try:
-        opts, _ = getopt.getopt(argv, "p:i:o:g:d:v:a:h")
+        opts, _ = getopt.getopt(argv, "p:i:o:g:c:f:m:e:n:l:d:v:a:y:k:z:u:x:q:h")
         for opt, arg in opts:
             if opt == '-p':
                 n_process = int(arg)
@@ -515,12 +993,36 @@ def main(argv):
                 out_dir = arg
             elif opt == '-g':
                 debug = ast.literal_eval(arg)
+            elif opt == '-c':
+                copy_files = ast.literal_eval(arg)
+            elif opt == '-f':
+                output_format = arg.lower()
+            elif opt == '-m':
+                stream = ast.literal_eval(arg)
+            elif opt == '-k':
+                cache_dir = arg
+            elif opt == '-z':
+                cache_size = int(arg)
+            elif opt == '-u':
+                incremental = ast.literal_eval(arg)
+            elif opt == '-x':
+                patch_store = ast.literal_eval(arg)
+            elif opt == '-q':
+                dedup = arg.lower()
+            elif opt == '-e':
+                contour_step = int(arg)
+            elif opt == '-n':
+                contour_points = int(arg)
+            elif opt == '-l':
+                intensity_threshold = int(arg)
             elif opt == '-d':
                 downsample_size = int(arg)
             elif opt == '-v':
                 variance_threshold = int(arg)
             elif opt == '-a':
                 angle = int(arg)
+            elif opt == '-y':
+                pyramid = ast.literal_eval(arg)
             elif opt == '-h':
                 print 'Example usage: python threaded_tile.py -i <input directory> -o <output directory>'
                 sys.exit(0)
@@ -537,40 +1039,128 @@ def main(argv):
         print 'Error: enter value for output directory (-o).'
         raise Exception
 
+    if output_format not in ['csv', 'npy']:
+        print 'Error: enter csv or npy for output format (-f).'
+        raise Exception
+
+    if patch_store and output_format != 'npy':
+        print 'Error: patch store (-x) requires npy output format (-f).'
+        raise Exception
+
+    if dedup not in ['none', 'image', 'global']:
+        print 'Error: enter none, image or global for dedup (-q).'
+        raise Exception
+
+    if dedup == 'global' and incremental:
+        print 'Error: global dedup (-q) cannot be combined with incremental'\
+              ' runs (-u).'
+        raise Exception
+
+    if contour_step < 1 or (contour_points != None and contour_points < 1):
+        print 'Error: enter positive values for contour step (-e) and contour'\
+              ' points (-n).'
+        raise Exception
+
+    if output_format == 'npy' and downsample_size == None:
+        print 'Error: npy output format (-f) requires downsample size (-d).'
+        raise Exception
+
+    if stream and downsample_size == None:
+        print 'Error: stream (-m) requires downsample size (-d).'
+        raise Exception
+
     print '-------------------------------------------------------------------'
     print 'Proceeding with options: '
     print 'Processes (-p)           = %s' % (n_process)
     print 'Input directory (i)      = %s' % (in_dir)
     print 'Output directory (-o)    = %s' % (out_dir)
     print 'Debug (-g)               = %s' % (debug)
+    print 'Copy files (-c)          = %s' % (copy_files)
+    print 'Output format (-f)       = %s' % (output_format)
+    print 'Stream (-m)              = %s' % (stream)
+    print 'Cache directory (-k)     = %s' % (cache_dir)
+    print 'Cache size (-z)          = %s' % (cache_size)
+    print 'Incremental (-u)         = %s' % (incremental)
+    print 'Patch store (-x)         = %s' % (patch_store)
+    print 'Dedup (-q)               = %s' % (dedup)
+    print 'Contour step (-e)        = %s' % (contour_step)
+    print 'Contour points (-n)      = %s' % (contour_points)
+    print 'Intensity threshold (-l) = %s' % (intensity_threshold)
     print 'Downsample size (-d)     = %s' % (downsample_size)
     print 'Variance threshold(-v)   = %s' % (variance_threshold)
     print 'Angle (-a)               = %s' % (angle)
+    print 'Pyramid (-y)             = %s' % (pyramid)
 
     # start execution timer
 
     bigtic = time.time()
 
-    # init chunk directory structure and copy chunks of files
+    # conditionally find new or modified images, otherwise remove manifest of
+    # earlier incremental run
+
+    name_list = None
+    drop_set = None
+    if incremental:
+        parameters = {'downsample_size': downsample_size,\
+                      'variance_threshold': variance_threshold,\
+                      'angle': angle,\
+                      'pyramid': pyramid,\
+                      'output_format': output_format,\
+                      'contour_step': contour_step,\
+                      'contour_points': contour_points,\
+                      'intensity_threshold': intensity_threshold,\
+                      'dedup': dedup,\
+                      'patch_store': patch_store}
+        out_name_list = ['originals.csv', 'patches.csv']
+        if output_format == 'npy':
+            out_name_list = ['originals.npy', 'originals_meta.npy',\
+                             'originals.schema.json', 'patches.npy',\
+                             'patches_meta.npy', 'patches.schema.json']
+        name_list, drop_set, file_dict = find_changed_images(in_dir, out_dir,\
+            parameters, out_name_list)
+        if len(name_list) == 0 and drop_set != None and len(drop_set) == 0:
+            print 'No new, modified or removed images.'
+            return
+    elif os.path.exists(out_dir + os.sep + 'manifest.json'):
+        os.remove(out_dir + os.sep + 'manifest.json')
+
+    # init chunk directory structure and assign (or copy) chunks of files
 
     create_out_dirs(n_process, out_dir)
-    chunk_files(n_process, in_dir, out_dir)
+    chunk_list = chunk_files(n_process, in_dir, out_dir, copy_files,\
+                             name_list)
+
+    # init directory of decoded greyscale images shared by all stages, or
+    # persistent cache of decoded greyscale images
+
+    grey_dir = out_dir + os.sep + '_grey_dir'
+    if cache_dir != None:
+        grey_dir = cache_dir
+    if not os.path.exists(grey_dir):
+        try:
+            os.makedirs(grey_dir)
+        except EnvironmentError as exception_:
+            print exception_
+            print 'Failed to create ' + grey_dir + '!'
+            sys.exit(-1)
 
     # multiprocessing map/reduce scheme to execute image manipulation tasks on
-    # chunks of image files in parallel
+    # image files in parallel, each process taking files from a shared queue
 
     # convert original images to contours in a csv file using multiprocessing
     # store in temporary files
 
     print '-------------------------------------------------------------------'
-    print 'Converting original images to csv ... '
+    print 'Converting original images to ' + output_format + ' ... '
     tic = time.time()
     processes = []
+    work_queue = queue_files(n_process, chunk_list)
     try:
         for i in range(0, int(n_process)):
             process_name = 'Process_' + str(i)
             process = Process(target=map_convert_originals, name=process_name,\
-            args=(i, out_dir))
+            args=(i, work_queue, out_dir, output_format, contour_step,\
+                  contour_points, intensity_threshold, grey_dir))
             process.start()
             processes.append(process)
         for process_ in processes:
@@ -578,34 +1168,52 @@ def main(argv):
         print 'Images converted in %.2f s.' % (time.time()-tic)
     except BaseException as exception_:
         print exception_
-        print 'ERROR: Could not convert original images to csv.'
+        print 'ERROR: Could not convert original images to ' + output_format +\
+            '.'
         print sys.exc_info()
         exit(-1)
 
-    # reduce temporary contour csv files into a single large csv
+    # reduce temporary contour files into a single large csv (or npy)
 
     print '-------------------------------------------------------------------'
-    print 'Combining original csv files ... '
+    print 'Combining original ' + output_format + ' files ... '
     tic = time.time()
-    reduce_join_original_csv(n_process, out_dir)
+    if output_format == 'npy':
+        reduce_join_original_npy(n_process, out_dir)
+    else:
+        reduce_join_original_csv(n_process, out_dir)
     print 'Done.'
-    print 'Csv files combined in %.2f s.' % (time.time()-tic)
+    print 'Files combined in %.2f s.' % (time.time()-tic)
 
     # tile images using multiprocessing
-    # store in temporary files
+    # store in temporary files, or stream to final output file
 
     print '-------------------------------------------------------------------'
     print 'Tiling images ... '
     tic = time.time()
     processes = []
+    work_queue = queue_files(n_process, chunk_list)
+    out_queue = None
+    if stream:
+        out_queue = Queue()
+    shared_dict = None
+    if dedup == 'global':
+        manager = multiprocessing.Manager()
+        shared_dict = manager.dict()
     try:
         for i in range(0, int(n_process)):
             process_name = 'Process_' + str(i)
             process = Process(target=map_make_tiles, name=process_name,\
-            args=(i, out_dir, debug, downsample_size,\
-                  variance_threshold, angle))
+            args=(i, work_queue, out_dir, debug, downsample_size,\
+                  variance_threshold, angle, output_format, out_queue,\
+                  pyramid, grey_dir, dedup, shared_dict))
             process.start()
             processes.append(process)
+        if stream:
+            reduce_stream(iter_batches(n_process, out_queue, processes),\
+                          out_dir, 'patches', debug, downsample_size,\
+                          output_format,\
+                          ['orig_name', 'x', 'y', 'size', 'angle'])
         for process_ in processes:
             process_.join()
         print 'Images tiled in %.2f s.' % (time.time()-tic)
@@ -615,14 +1223,53 @@ def main(argv):
         print sys.exc_info()
         exit(-1)
 
-    # reduce temporary files into a single large csv
-
-    print '-------------------------------------------------------------------'
-    print 'Combining tile csv files ... '
-    tic = time.time()
-    reduce_join_tile_csv(n_process, out_dir, debug, downsample_size)
-    print 'Done.'
-    print 'Csv files combined in %.2f s.' % (time.time()-tic)
+    # trim persistent cache only once all stages have read the decoded images
+
+    if cache_dir != None:
+        evict_greyscale_cache(cache_dir, cache_size, None)
+
+    # reduce temporary files into a single large csv (or npy)
+
+    if not stream:
+        print '---------------------------------------------------------------'
+        print 'Combining tile ' + output_format + ' files ... '
+        tic = time.time()
+        if output_format == 'npy':
+            reduce_join_npy(n_process, out_dir, 'patches', debug,\
+                            downsample_size)
+        else:
+            reduce_join_tile_csv(n_process, out_dir, debug, downsample_size)
+        print 'Done.'
+        print 'Files combined in %.2f s.' % (time.time()-tic)
+
+    # conditionally merge output of earlier run and write manifest
+
+    if incremental:
+        if drop_set != None:
+            print '---------------------------------------------------------------'
+            print 'Merging output of earlier run ... '
+            if output_format == 'npy':
+                merge_previous_original_npy(out_dir, drop_set)
+                merge_previous_npy(out_dir, 'patches', drop_set, downsample_size)
+            else:
+                merge_previous_csv(out_dir, 'originals.csv', drop_set, 3)
+                merge_previous_csv(out_dir, 'patches.csv', drop_set, -5)
+            shutil.rmtree(out_dir + os.sep + '_previous', ignore_errors=True)
+            print 'Done.'
+        save_manifest(out_dir, parameters, file_dict)
+
+    # conditionally sort rows into patch store
+
+    if patch_store:
+        tic = time.time()
+        print '---------------------------------------------------------------'
+        print 'Sorting patch store ... '
+        sort_npy(out_dir, 'patches', downsample_size)
+        print 'Done.'
+        print 'Patch store sorted in %.2f s.' % (time.time()-tic)
+
+    if not debug:
+        shutil.rmtree(out_dir + os.sep + '_grey_dir', ignore_errors=True)
 
     print '-------------------------------------------------------------------'
     print 'All tasks completed in %.2f s.' % (time.time()-bigtic)